@@ -0,0 +1,229 @@
+#! /usr/bin/env python
+
+#
+# Copyright (c) 2015 Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+## Content-addressed build cache for create-tftf and create-ffff
+#
+# A build is identified by a key: the SHA-256 of the tool's name, its
+# normalized arguments (with input files replaced by the hashes of their
+# contents), and the bootrom-tools sources themselves.  The build's output
+# files are stored under <cache dir>/<key[:2]>/<key>/, and on a later build
+# with the same key they are copied (or hard-linked) into place instead of
+# being rebuilt.  The cache is kept under a size limit by evicting the
+# least-recently-used entries.
+#
+from __future__ import print_function
+import os
+import errno
+import hashlib
+import json
+import shutil
+import stat
+import tempfile
+from util import warning
+
+BUILD_CACHE_DIR_DEFAULT = os.path.join("~", ".cache", "bootrom-tools")
+BUILD_CACHE_SIZE_DEFAULT = 1024 * 1024 * 1024
+
+# Size of the chunks in which input files are hashed
+BUILD_CACHE_HASH_BLOCK_SIZE = 1024 * 1024
+
+# Command line arguments common to the tools which use the cache
+BUILD_CACHE_ARGUMENTS = [
+    (["--cache"], {"action": "store_true",
+                   "help": "Reuse identical earlier builds from the "
+                   "build cache"}),
+    (["--cache-dir"], {"default": os.environ.get("BOOTROM_TOOLS_CACHE",
+                                                 BUILD_CACHE_DIR_DEFAULT),
+                       "help": "The build cache folder "
+                       "(~/.cache/bootrom-tools)"}),
+    (["--cache-size"], {"type": lambda x: int(x, 0),
+                        "default": BUILD_CACHE_SIZE_DEFAULT,
+                        "help": "The maximum size of the build cache, "
+                        "in bytes (1 GiB)"}),
+    (["--cache-link"], {"action": "store_true",
+                        "help": "Hard-link cached builds into place rather "
+                        "than copying them"})]
+
+# Memoized hash of the bootrom-tools sources
+tools_digest = None
+
+
+def hash_file(filename, offset=0, length=None):
+    """Return the SHA-256 (hex) digest of (part of) a file"""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as rf:
+        rf.seek(offset)
+        while length is None or length > 0:
+            size = BUILD_CACHE_HASH_BLOCK_SIZE
+            if length is not None:
+                size = min(size, length)
+            blob = rf.read(size)
+            if not blob:
+                break
+            digest.update(blob)
+            if length is not None:
+                length -= len(blob)
+    return digest.hexdigest()
+
+
+def get_tools_digest():
+    # Hash the bootrom-tools sources, so that changes to the tools
+    # invalidate the cache
+    global tools_digest
+    if not tools_digest:
+        folder = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha256()
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if name.endswith(".py") or name.startswith("create-"):
+                if os.path.isfile(path):
+                    digest.update(name + "\0" + hash_file(path) + "\0")
+        tools_digest = digest.hexdigest()
+    return tools_digest
+
+
+class BuildCache:
+    """A size-bounded, content-addressed cache of build outputs"""
+    def __init__(self, cache_dir=None, max_size=BUILD_CACHE_SIZE_DEFAULT,
+                 link=False):
+        self.cache_dir = os.path.expanduser(cache_dir or
+                                            BUILD_CACHE_DIR_DEFAULT)
+        self.max_size = max_size
+        self.link = link
+
+    def make_key(self, tool, normalized_args):
+        """Return the cache key for a build
+
+        normalized_args is any JSON-serializable description of the build
+        inputs (with input files already replaced by their hashes; see
+        hash_file).
+        """
+        digest = hashlib.sha256()
+        digest.update(tool + "\0")
+        digest.update(get_tools_digest() + "\0")
+        digest.update(json.dumps(normalized_args, sort_keys=True))
+        return digest.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, outputs):
+        """Copy a cached build's outputs into place
+
+        outputs is the list of output filenames, in the same order as when
+        the build was stored.  Returns True on a cache hit, False if the
+        build isn't cached (or couldn't be retrieved).
+        """
+        entry = self.entry_dir(key)
+        if not os.path.isdir(entry):
+            return False
+        try:
+            for index, filename in enumerate(outputs):
+                cached = os.path.join(entry, str(index))
+                if not os.path.isfile(cached):
+                    return False
+                if os.path.lexists(filename):
+                    os.remove(filename)
+                if self.link:
+                    try:
+                        os.link(cached, filename)
+                        continue
+                    except OSError:
+                        # e.g., crossing file systems
+                        pass
+                shutil.copyfile(cached, filename)
+            # Mark the entry as recently used
+            os.utime(entry, None)
+        except EnvironmentError as e:
+            warning("Unable to use the build cache:", e)
+            return False
+        return True
+
+    def store(self, key, outputs):
+        """Add a build's outputs to the cache, then trim the cache
+
+        Failures are reported as warnings, since the build itself has
+        succeeded.
+        """
+        entry = self.entry_dir(key)
+        try:
+            parent = os.path.dirname(entry)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            # Assemble the entry beside its final location and rename it
+            # into place, so that other builds never see a partial entry
+            staging = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+            try:
+                # (The cached files are read-only, so that outputs which
+                # are hard-linked to them can't be modified in place by
+                # accident.  The tools replace or unshare such outputs
+                # rather than overwriting them; see: util.create_file.)
+                for index, filename in enumerate(outputs):
+                    cached = os.path.join(staging, str(index))
+                    shutil.copyfile(filename, cached)
+                    os.chmod(cached, stat.S_IRUSR | stat.S_IRGRP |
+                             stat.S_IROTH)
+                os.rename(staging, entry)
+            except OSError as e:
+                shutil.rmtree(staging, ignore_errors=True)
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        except EnvironmentError as e:
+            warning("Unable to update the build cache:", e)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least-recently-used entries until the cache fits"""
+        entries = []
+        total_size = 0
+        try:
+            for prefix in os.listdir(self.cache_dir):
+                prefix_dir = os.path.join(self.cache_dir, prefix)
+                if not os.path.isdir(prefix_dir):
+                    continue
+                for key in os.listdir(prefix_dir):
+                    entry = os.path.join(prefix_dir, key)
+                    if key.startswith(".tmp-") or not os.path.isdir(entry):
+                        continue
+                    size = sum(os.path.getsize(os.path.join(entry, name))
+                               for name in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                    total_size += size
+        except EnvironmentError as e:
+            warning("Unable to scan the build cache:", e)
+            return
+
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
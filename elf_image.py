@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+
+#
+# Copyright (c) 2015 Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+## Minimal ELF reader, for extracting loadable segments from an executable
+#
+# Only the ELF header and program header table are parsed, so this is much
+# cheaper (to import and to run) than a general ELF library.  The file is
+# mmapped just long enough to read the headers: the segment contents are
+# left in the file, to be read when the TFTF is written out.
+#
+from __future__ import print_function
+import os
+import mmap
+from struct import Struct
+
+ELF_MAGIC = "\x7fELF"
+ELF_CLASS_32 = 1
+ELF_CLASS_64 = 2
+ELF_DATA_LSB = 1
+ELF_DATA_MSB = 2
+
+ELF_OFF_CLASS = 4
+ELF_OFF_DATA = 5
+ELF_IDENT_SIZE = 16
+
+# Program header types and flags
+PT_LOAD = 1
+PF_X = 0x1
+PF_W = 0x2
+PF_R = 0x4
+
+# The part of the ELF header following e_ident which we care about:
+#   e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags,
+#   e_ehsize, e_phentsize, e_phnum
+elf_header_formats = {
+    ELF_CLASS_32: "HHLLLLLHHH",
+    ELF_CLASS_64: "HHLQQQLHHH",
+}
+
+# Program header layouts, normalized below to:
+#   (p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz)
+elf_phdr_formats = {
+    ELF_CLASS_32: "LLLLLLL",    # type, offset, vaddr, paddr, filesz,
+                                # memsz, flags (+ align, not needed)
+    ELF_CLASS_64: "LLQQQQQ",    # type, flags, offset, vaddr, paddr,
+                                # filesz, memsz (+ align, not needed)
+}
+
+elf_byte_orders = {
+    ELF_DATA_LSB: "<",
+    ELF_DATA_MSB: ">",
+}
+
+
+class ElfSegment:
+    """A loadable (PT_LOAD) ELF segment
+
+    offset and file_length locate the segment contents in the ELF file;
+    mem_length is the size of the segment in memory, which is larger than
+    file_length when the segment has a zero-filled (.bss) tail.
+    """
+    def __init__(self, flags, offset, address, file_length, mem_length):
+        self.flags = flags
+        self.offset = offset
+        self.address = address
+        self.file_length = file_length
+        self.mem_length = mem_length
+
+    def is_code(self):
+        return (self.flags & PF_X) != 0
+
+    def coalesce(self, segment):
+        """Merge a following segment into this one, if possible
+
+        Segments are merged if they are of the same kind (code or data)
+        and are contiguous both in memory and in the file.  Returns True
+        if the segment was merged.
+        """
+        if segment.is_code() != self.is_code():
+            return False
+        if segment.address != self.address + self.mem_length:
+            return False
+        if segment.file_length == 0:
+            # Pure zero-fill: just extend our zero-filled tail
+            self.mem_length += segment.mem_length
+            return True
+        if self.mem_length != self.file_length or \
+           segment.offset != self.offset + self.file_length:
+            # We have a zero-filled tail, or the contents aren't adjacent
+            # in the file
+            return False
+        self.flags |= segment.flags
+        self.file_length += segment.file_length
+        self.mem_length += segment.mem_length
+        return True
+
+
+class ElfImage:
+    """The loadable parts of an ELF executable"""
+    def __init__(self, filename):
+        """Constructor
+
+        Reads the ELF and program headers from filename, raising IOError if
+        the file can't be read and ValueError if it isn't a usable ELF
+        executable.
+        """
+        self.filename = filename
+        self.entry = 0
+        self.segments = []
+        with open(filename, 'rb') as rf:
+            file_size = os.fstat(rf.fileno()).st_size
+            if file_size < ELF_IDENT_SIZE:
+                raise ValueError("{0:s} is not an ELF file".format(filename))
+            elf_map = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.parse(elf_map, file_size)
+            finally:
+                elf_map.close()
+
+    def parse(self, elf_map, file_size):
+        # Parse the ELF header and program header table
+        if elf_map[0:4] != ELF_MAGIC:
+            raise ValueError("{0:s} is not an ELF file".format(self.filename))
+        elf_class = ord(elf_map[ELF_OFF_CLASS])
+        byte_order = elf_byte_orders.get(ord(elf_map[ELF_OFF_DATA]))
+        if elf_class not in elf_header_formats or byte_order is None:
+            raise ValueError("{0:s}: unsupported ELF class/encoding".
+                             format(self.filename))
+
+        header_struct = Struct(byte_order + elf_header_formats[elf_class])
+        phdr_struct = Struct(byte_order + elf_phdr_formats[elf_class])
+        if file_size < ELF_IDENT_SIZE + header_struct.size:
+            raise ValueError("{0:s}: truncated ELF header".
+                             format(self.filename))
+        (e_type, e_machine, e_version, self.entry, e_phoff, e_shoff,
+         e_flags, e_ehsize, e_phentsize, e_phnum) = \
+            header_struct.unpack_from(elf_map, ELF_IDENT_SIZE)
+
+        if e_phnum == 0:
+            raise ValueError("{0:s} has no program headers".
+                             format(self.filename))
+        if e_phentsize < phdr_struct.size or \
+           e_phoff + e_phnum * e_phentsize > file_size:
+            raise ValueError("{0:s}: bad program header table".
+                             format(self.filename))
+
+        for index in range(e_phnum):
+            fields = phdr_struct.unpack_from(elf_map,
+                                             e_phoff + index * e_phentsize)
+            if elf_class == ELF_CLASS_32:
+                (p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz,
+                 p_flags) = fields
+            else:
+                (p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz,
+                 p_memsz) = fields
+            if p_type != PT_LOAD or p_memsz == 0:
+                continue
+            if p_offset + p_filesz > file_size:
+                raise ValueError("{0:s}: segment {1:d} is truncated".
+                                 format(self.filename, index))
+            self.segments.append(ElfSegment(p_flags, p_offset, p_vaddr,
+                                            p_filesz, max(p_memsz, p_filesz)))
+
+        if not self.segments:
+            raise ValueError("{0:s} has no loadable segments".
+                             format(self.filename))
+
+    def get_load_segments(self):
+        """Return the loadable segments, coalescing adjacent ones
+
+        Segments are sorted by load address, and runs of segments of the
+        same kind which are contiguous in both memory and the file are
+        merged into single segments.
+        """
+        coalesced = []
+        for segment in sorted(self.segments, key=lambda s: s.address):
+            if not coalesced or not coalesced[-1].coalesce(segment):
+                coalesced.append(ElfSegment(segment.flags, segment.offset,
+                                            segment.address,
+                                            segment.file_length,
+                                            segment.mem_length))
+        return coalesced
@@ -29,27 +29,25 @@
 #
 
 from __future__ import print_function
-from time import gmtime, strftime
 from struct import unpack_from, pack_into
 from ffff_element import FFFF_HDR_VALID, \
-    FFFF_MAX_HEADER_BLOCK_SIZE, FFFF_HDR_OFF_TAIL_SENTINEL, \
-    FFFF_HDR_OFF_ELEMENT_TBL, FFFF_HDR_NUM_ELEMENTS, FfffElement, \
+    FFFF_MAX_HEADER_BLOCK_SIZE, FfffElement, get_ffff_header_layout, \
     FFFF_ELT_LENGTH, FFFF_HDR_OFF_FLASH_IMAGE_NAME, \
     FFFF_HDR_OFF_FLASH_CAPACITY, FFFF_FLASH_IMAGE_NAME_LENGTH, \
     FFFF_ELEMENT_END_OF_ELEMENT_TABLE, FFFF_HEADER_COLLISION, \
-    FFFF_HDR_ERASED, FFFF_RSVD_SIZE, FFFF_SENTINEL, \
+    FFFF_HDR_ERASED, FFFF_RSVD_SIZE, FFFF_SENTINEL, FFFF_FILL_DEFAULT, \
     FFFF_HDR_INVALID, FFFF_HDR_OFF_SENTINEL, \
     FFFF_HDR_OFF_TIMESTAMP, FFFF_HDR_OFF_ERASE_BLOCK_SIZE, \
     FFFF_HDR_OFF_HEADER_SIZE, FFFF_HDR_OFF_FLASH_IMAGE_LENGTH, \
-    FFFF_HDR_OFF_HEADER_GENERATION_NUM, FFFF_HDR_OFF_RESERVED, \
+    FFFF_HDR_OFF_HEADER_GENERATION_NUM, \
     FFFF_ELT_OFF_TYPE, FFFF_ELT_OFF_CLASS, FFFF_ELT_OFF_ID, \
     FFFF_ELT_OFF_GENERATION, FFFF_ELT_OFF_LOCATION, \
-    FFFF_ELT_OFF_LENGTH, FFFF_HDR_NUM_RESERVED, FFFF_HDR_LEN_FIXED_PART, \
-    FFFF_HEADER_SIZE_MIN, FFFF_HEADER_SIZE_MAX, FFFF_HEADER_SIZE_DEFAULT, \
-    FFFF_HDR_LEN_MIN_RESERVED
-import sys
+    FFFF_ELT_OFF_LENGTH, FFFF_HEADER_SIZE_MIN, FFFF_HEADER_SIZE_MAX, \
+    FFFF_HEADER_SIZE_DEFAULT
+import os
+from interval_index import IntervalIndex, find_duplicates
 from util import error, is_power_of_2, next_boundary, is_constant_fill, \
-    PROGRAM_ERRORS
+    get_fill_byte, get_timestamp, copy_into
 
 
 def get_header_block_size(erase_block_size, header_size):
@@ -99,7 +97,7 @@ class Ffff:
         self.erase_block_size = erase_block_size
         self.flash_image_length = image_length
         self.header_generation_number = header_generation_number
-        self.reserved = [0] * FFFF_HDR_NUM_RESERVED
+        self.reserved = []
         self.elements = []
         self.tail_sentinel = ""
 
@@ -113,6 +111,11 @@ class Ffff:
         self.recalculate_header_offsets()
 
         self.ffff_buf = buf
+        # The value of the unused parts of the header (besides zero)
+        self.fill_byte = FFFF_FILL_DEFAULT
+        # Element TFTFs, parsed on demand and keyed by (location, length)
+        # (see: FfffElement.get_tftf)
+        self.element_tftfs = {}
         self.collisions = []
         self.collisions_found = False
         self.duplicates = []
@@ -128,40 +131,16 @@ class Ffff:
                          0, 0, 0, 0, 0, None)
 
     def recalculate_header_offsets(self):
-        """ Recalculate element table size and offsets from header_size
+        """ Select the header layout matching header_size
 
-        Because we have variable-size FFFF headers, we need to recalculate the
-        number of entries in the section table, and the offsets to all fields
-        which follow.
+        Because we have variable-size FFFF headers, the number of entries in
+        the element table, and the offsets to all fields which follow, depend
+        on the header size.  These live in a per-instance (shared, read-only)
+        FfffHeaderLayout rather than in module globals, so FFFFs with
+        different header sizes can be handled concurrently.
         """
-        """ Recalculate element table size and offsets from header_size
-
-        Because we have variable-size FFFF headers, we need to recalculate the
-        number of entries in the section table, and the offsets to all fields
-        which follow.
-        """
-        global FFFF_HDR_NUM_ELEMENTS, FFFF_HDR_LEN_ELEMENT_TBL, \
-            FFFF_HDR_NUM_RESERVED, FFFF_HDR_LEN_RESERVED, \
-            FFFF_HDR_OFF_RESERVED, FFFF_HDR_OFF_TAIL_SENTINEL, \
-            FFFF_HDR_LEN_MIN_RESERVED
-        # TFTF section table and derived lengths
-        FFFF_HDR_NUM_ELEMENTS = \
-            ((self.header_size -
-             (FFFF_HDR_LEN_FIXED_PART + FFFF_HDR_LEN_MIN_RESERVED)) //
-             FFFF_ELT_LENGTH)
-        FFFF_HDR_LEN_ELEMENT_TBL = (FFFF_HDR_NUM_ELEMENTS * FFFF_ELT_LENGTH)
-
-        FFFF_HDR_LEN_RESERVED = (self.header_size -
-                                (FFFF_HDR_LEN_FIXED_PART +
-                                 FFFF_HDR_LEN_ELEMENT_TBL))
-        FFFF_HDR_NUM_RESERVED = FFFF_HDR_LEN_RESERVED / FFFF_RSVD_SIZE
-        self.reserved = [0] * FFFF_HDR_NUM_RESERVED
-
-        # Offsets to fields following the section table
-        FFFF_HDR_OFF_ELEMENT_TBL = (FFFF_HDR_OFF_RESERVED +
-                                    FFFF_HDR_LEN_RESERVED)
-        FFFF_HDR_OFF_TAIL_SENTINEL = (FFFF_HDR_OFF_ELEMENT_TBL +
-                                      FFFF_HDR_LEN_ELEMENT_TBL)
+        self.layout = get_ffff_header_layout(self.header_size)
+        self.reserved = [0] * self.layout.num_reserved
 
     def get_header_block_size(self):
         return get_header_block_size(self.erase_block_size, self.header_size)
@@ -169,9 +148,8 @@ class Ffff:
     def unpack(self):
         """Unpack an FFFF header from a buffer"""
 
-        fmt_string = "<16s16s48sLLLLL" + "L" * FFFF_HDR_NUM_RESERVED
-        ffff_hdr = unpack_from(fmt_string, self.ffff_buf,
-                               self.header_offset)
+        ffff_hdr = self.layout.header_struct.unpack_from(self.ffff_buf,
+                                                         self.header_offset)
         self.sentinel = ffff_hdr[0]
         self.timestamp = ffff_hdr[1]
         self.flash_image_name = ffff_hdr[2]
@@ -180,17 +158,22 @@ class Ffff:
         self.header_size = ffff_hdr[5]
         self.flash_image_length = ffff_hdr[6]
         self.header_generation_number = ffff_hdr[7]
-        for i in range(FFFF_HDR_NUM_RESERVED):
-            self.reserved[i] = ffff_hdr[8+i]
 
         # Now that we have parsed the header_size, recalculate the size of the
         # element table and the offsets to all FFFF header fields which follow
         # it.
-        self.recalculate_header_offsets()
+        if self.layout.header_size != self.header_size and \
+           self.header_size >= FFFF_HEADER_SIZE_MIN and \
+           self.header_size <= FFFF_HEADER_SIZE_MAX:
+            self.recalculate_header_offsets()
+            ffff_hdr = self.layout.header_struct.unpack_from(
+                self.ffff_buf, self.header_offset)
+        self.reserved = list(ffff_hdr[8:])
 
         # Unpack the tail sentinel
         ffff_hdr = unpack_from("<16s", self.ffff_buf,
-                               self.header_offset + FFFF_HDR_OFF_TAIL_SENTINEL)
+                               self.header_offset +
+                               self.layout.off_tail_sentinel)
         self.tail_sentinel = ffff_hdr[0]
 
         # Determine the ROM range that can hold the elements
@@ -199,13 +182,14 @@ class Ffff:
 
         # Parse the table of element headers
         self.elements = []
-        offset = FFFF_HDR_OFF_ELEMENT_TBL
-        for index in range(FFFF_HDR_NUM_ELEMENTS):
+        offset = self.header_offset + self.layout.off_element_tbl
+        for index in range(self.layout.num_elements):
             element = FfffElement(index,
                                   self.ffff_buf,
                                   self.flash_capacity,
                                   self.erase_block_size,
                                   0, 0, 0, 0, 0, 0)
+            element.tftf_cache = self.element_tftfs
             eot = element.unpack(self.ffff_buf, offset)
             self.elements.append(element)
             offset += FFFF_ELT_LENGTH
@@ -224,13 +208,13 @@ class Ffff:
         # Populate the fixed part of the FFFF header.
         # (Note that we need to break up the packing because the "s" format
         # won't zero-pad a string shorter than the field width)
-        timestamp = strftime("%Y%m%d %H%M%S", gmtime())
+        if not self.timestamp:
+            self.timestamp = get_timestamp()
         pack_into("<16s16s", self.ffff_buf, self.header_offset,
-                  self.sentinel, timestamp)
-        if self.flash_image_name:
-            pack_into("<48s", self.ffff_buf,
-                      self.header_offset + FFFF_HDR_OFF_FLASH_IMAGE_NAME,
-                      self.flash_image_name)
+                  self.sentinel, self.timestamp)
+        pack_into("<48s", self.ffff_buf,
+                  self.header_offset + FFFF_HDR_OFF_FLASH_IMAGE_NAME,
+                  self.flash_image_name or "")
         pack_into("<LLLLL", self.ffff_buf,
                   self.header_offset + FFFF_HDR_OFF_FLASH_CAPACITY,
                   self.flash_capacity,
@@ -238,36 +222,36 @@ class Ffff:
                   self.header_size,
                   self.flash_image_length,
                   self.header_generation_number)
-        for i in range(FFFF_HDR_NUM_RESERVED):
-            pack_into("<L", self.ffff_buf,
-                      self.header_offset + FFFF_HDR_OFF_RESERVED +
-                      (FFFF_RSVD_SIZE * i),
-                      self.reserved[i])
+        self.layout.reserved_struct.pack_into(self.ffff_buf,
+                                              self.header_offset +
+                                              self.layout.off_reserved,
+                                              *self.reserved)
 
         # Pack the element headers into the FFFF header buffer
-        offset = self.header_offset + FFFF_HDR_OFF_ELEMENT_TBL
+        offset = self.header_offset + self.layout.off_element_tbl
         for element in self.elements:
             offset = element.pack(self.ffff_buf, offset)
 
         # Finally, add the tail sentinel
         pack_into("<16s", self.ffff_buf,
-                  self.header_offset + FFFF_HDR_OFF_TAIL_SENTINEL,
+                  self.header_offset + self.layout.off_tail_sentinel,
                   self.tail_sentinel)
 
     def add_element(self, element_type, element_class, element_id,
                     element_length, element_location, element_generation,
-                    filename):
+                    filename, tftf_blob=None, copy_data=True):
         """Add a new element to the element table
 
-        Adds an element to the element table but doesn't load the TFTF
-        file into the ROMimage buffer.  That is done later by post_process.
+        Adds an element to the element table and, if copy_data is set,
+        copies its TFTF into the ROMimage buffer.  The TFTF is loaded from
+        filename unless an already-loaded tftf_blob is supplied.
         Returns a success flag
 
         (We would typically be called by "create-ffff" after parsing element
         parameters.)
         """
         num_elements = len(self.elements)
-        if num_elements < FFFF_HDR_NUM_ELEMENTS:
+        if num_elements < self.layout.num_elements:
             element = FfffElement(len(self.elements),
                                   self.ffff_buf,
                                   self.flash_capacity,
@@ -279,6 +263,7 @@ class Ffff:
                                   element_location,
                                   element_generation,
                                   filename)
+            element.tftf_blob = tftf_blob
             if element_type == FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
                 if num_elements == 0:
                     # Special case, add the EOT element
@@ -286,13 +271,22 @@ class Ffff:
                 return True
 
             if element.init():
+                # Reject an element which would run past the end of the
+                # image before copying it into the ROMimage buffer (which,
+                # with --sparse, is a file mapping of just the image length)
+                if self.flash_image_length != 0 and \
+                   element.element_location + element.element_length > \
+                   self.flash_image_length:
+                    error(self.get_overrun_message(element))
+                    return False
+
                 # Because the table always ends in a EOT entry, we "append"
                 # new elements by inserting them just before the EOT element.
                 self.elements.insert(num_elements - 1, element)
 
-                span_start = element.element_location
-                span_end = span_start + len(element.tftf_blob.tftf_buf)
-                self.ffff_buf[span_start:span_end] = element.tftf_blob.tftf_buf
+                if copy_data:
+                    copy_into(self.ffff_buf, element.element_location,
+                              element.tftf_blob.tftf_buf)
                 return True
             else:
                 return False
@@ -300,6 +294,15 @@ class Ffff:
             error("too many elements")
             return False
 
+    def get_overrun_message(self, element):
+        # Describe an element which runs past the end of the image
+        return "--element-location " + \
+            format(element.element_location, "#x") + \
+            " + --element-length " + \
+            format(element.element_length, "#x") + \
+            " exceeds --image-length " + \
+            format(self.flash_image_length, "#x")
+
     def validate_element_table(self):
         # Check for element validity, inter-element collisions and
         # duplicate elements
@@ -313,60 +316,66 @@ class Ffff:
         self.duplicates_found = False
         self.invalid_elements_found = False
 
-        for i, elt_a in enumerate(self.elements):
-            collision = []
-            duplicate = []
-
-            if elt_a.element_type == FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
+        # Index the element spans and identities (type, ID, generation).
+        # Per the specification: "At most, one element table entry with a
+        # particular element type, element ID, and element generation may
+        # be present in the element table."
+        elements = []
+        for element in self.elements:
+            if element.element_type == FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
                 break
+            elements.append(element)
+        elements_by_index = dict((element.index, element)
+                                 for element in elements)
+        locations = IntervalIndex()
+        for element in elements:
+            locations.add(element.element_location, element.element_length,
+                          element.index)
+        duplicates = find_duplicates(
+            (element.index, (element.element_type, element.element_id,
+                             element.element_generation))
+            for element in elements)
+
+        header_blocks_end = 2 * self.get_header_block_size()
+        for elt_a in elements:
+            collision = []
 
             # Check for an invalid element (i.e., either munged or
             # collides with the 2 FFFF header blocks)
             if not elt_a.validate(self.element_location_min,
                                   self.element_location_max):
                 self.invalid_elements_found = True
-            if elt_a.element_location < (2 * self.get_header_block_size()):
+            if elt_a.element_location < header_blocks_end:
                 self.collisions_found = True
                 collision += [FFFF_HEADER_COLLISION]
                 error("Element at location " +
                       format(elt_a.element_location, "#x") +
                       " collides with two header blocks of size " +
-                      format(2 * self.get_header_block_size(), "#x"))
-
-            for j, elt_b in enumerate(self.elements):
-                # skip checking one's self
-                if i != j:
-                    # extract elements[j]
-                    if elt_b.element_type == \
-                            FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
-                        break
-
-                    # check for collision
-                    elt_a.validate_against(elt_b)
-                    start_a = elt_a.element_location
-                    end_a = start_a + elt_a.element_length - 1
+                      format(header_blocks_end, "#x"))
+
+            # Check for collisions and duplicates with the other elements
+            elt_a.validate_against(locations, duplicates)
+            if elt_a.collisions:
+                self.collisions_found = True
+                collision += elt_a.collisions
+                start_a = elt_a.element_location
+                end_a = start_a + elt_a.element_length - 1
+                for j in elt_a.collisions:
+                    # (Report each colliding pair once)
+                    if j < elt_a.index:
+                        continue
+                    elt_b = elements_by_index[j]
                     start_b = elt_b.element_location
                     end_b = start_b + elt_b.element_length - 1
-                    if end_b >= start_a and start_b <= end_a:
-                        self.collisions_found = True
-                        collision += [j]
-                        error("Element [{0:d}] @ {1:x}-{2:x} collides with "\
-                              "element [{3:d}] @ {4:x}-{5:x}".
-                              format(i, start_a, end_a, j, start_b, end_b)) 
-
-                    # check for other duplicate entries
-                    # Per the specification: "At most, one element table
-                    # entry with a particular element type, element ID,
-                    # and element generation may be present in the element
-                    # table."
-                    if elt_a.element_type == elt_b.element_type and \
-                       elt_a.element_id == elt_b.element_id and \
-                       elt_a.element_generation == elt_b.element_generation:
-                        self.duplicates_found = True
-                        duplicate += [j]
+                    error("Element [{0:d}] @ {1:x}-{2:x} collides with "
+                          "element [{3:d}] @ {4:x}-{5:x}".
+                          format(elt_a.index, start_a, end_a,
+                                 j, start_b, end_b))
+            if elt_a.duplicates:
+                self.duplicates_found = True
 
             self.collisions += [collision]
-            self.duplicates += [duplicate]
+            self.duplicates += [elt_a.duplicates]
         if self.collisions_found:
             error("Found collisions in FFFF element table!")
         if self.duplicates_found:
@@ -387,8 +396,7 @@ class Ffff:
 
         span = self.ffff_buf[self.header_offset:
                              self.header_offset+self.header_size]
-        if is_constant_fill(span, 0) or \
-           is_constant_fill(span, 0xff):
+        if get_fill_byte(span) in (0x00, 0xff):
             error("FFFF header validates as erased.")
             self.header_validity = FFFF_HDR_ERASED
             return self.header_validity
@@ -421,13 +429,15 @@ class Ffff:
                 self.header_validity = FFFF_HDR_INVALID
                 return self.header_validity
 
-        # Verify that the unused portions of the header are zeroed, per spec.
-        span_start = self.header_offset + FFFF_HDR_OFF_ELEMENT_TBL + \
+        # Verify that the unused portions of the header are zeroed, per spec
+        # (or hold the image's fill byte).
+        span_start = self.header_offset + self.layout.off_element_tbl + \
             len(self.elements) * FFFF_ELT_LENGTH
-        span_end = self.header_offset + FFFF_HDR_OFF_TAIL_SENTINEL - \
-            span_start
-        if not is_constant_fill(self.ffff_buf[span_start:span_end], 0):
-            error("Unused portions of FFFF header are non-zero: "
+        span_end = self.header_offset + self.layout.off_tail_sentinel
+        span = self.ffff_buf[span_start:span_end]
+        if not (is_constant_fill(span, 0) or
+                is_constant_fill(span, self.fill_byte)):
+            error("Unused portions of FFFF header are not blank: "
                   "(0x{0:x}-0x{1:x})".format(span_start, span_end))
             self.header_validity = FFFF_HDR_INVALID
             return self.header_validity
@@ -447,6 +457,7 @@ class Ffff:
         files into the buffer at those locations.
 
         (Called by "create-ffff" after processing all arguments)
+        Raises ValueError if an element runs past the end of the image.
         """
         # Revalidate the erase block size
         self.erase_block_mask = self.erase_block_size - 1
@@ -462,15 +473,9 @@ class Ffff:
                     error("Note: Assuming element [{0:d}]"
                           " loads at {1:08x}".format(element.index, location))
                 if self.flash_image_length != 0 and \
-                   element.element_location + element.element_length >= \
+                   element.element_location + element.element_length > \
                    self.flash_image_length:
-                    error("--element-location " +
-                          format(element.element_location, "#x") +
-                          " + --element-length " +
-                          format(element.element_length, "#x") +
-                          " exceeds --image-length " +
-                          format(self.flash_image_length, "#x"))
-                    sys.exit(PROGRAM_ERRORS)
+                    raise ValueError(self.get_overrun_message(element))
                 location = next_boundary(element.element_location +
                                          element.element_length,
                                          self.erase_block_size)
@@ -485,7 +490,8 @@ class Ffff:
         # fill in and/or trim selected FFFF fields
         self.sentinel = FFFF_SENTINEL
 
-        self.timestamp = strftime("%Y%m%d %H%M%S", gmtime())
+        if not self.timestamp:
+            self.timestamp = get_timestamp()
         if self.flash_image_name:
             self.flash_image_name = \
                 self.flash_image_name[0:FFFF_FLASH_IMAGE_NAME_LENGTH]
@@ -529,6 +535,35 @@ class Ffff:
             if element.element_type == FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
                 break
 
+    def explode(self, directory):
+        """Describe the files an FFFF header and its elements explode into
+
+        Returns the header's entry for an exploded FFFF's index (see:
+        FfffRomimage.explode_tree) and the list of (filename, offset,
+        length) ranges of the ROM image buffer to write: the header in
+        <directory>/header.bin, and each element in its own subdirectory
+        (see: FfffElement.explode).
+        """
+        header_file = os.path.join(directory, "header.bin")
+        extracts = [(header_file, self.header_offset, self.header_size)]
+        elements = []
+        for index, element in enumerate(self.elements):
+            if element.element_type == FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
+                break
+            element_entry, element_extracts = element.explode(
+                os.path.join(directory, "element_{0:02d}_{1:s}".format(
+                             index, element.element_short_name(
+                                 element.element_type) or "unknown")))
+            elements.append(element_entry)
+            extracts += element_extracts
+        entry = {"offset": self.header_offset,
+                 "header_size": self.header_size,
+                 "generation": self.header_generation_number,
+                 "timestamp": self.timestamp.rstrip("\0").decode("latin-1"),
+                 "file": header_file,
+                 "elements": elements}
+        return entry, extracts
+
     def display_element_table(self):
         # Display the FFFF header's element table in human-readable form
 
@@ -540,12 +575,12 @@ class Ffff:
                 break
 
         # Note any unused elements
-        num_unused_elements = FFFF_HDR_NUM_ELEMENTS - len(self.elements)
+        num_unused_elements = self.layout.num_elements - len(self.elements)
         if num_unused_elements > 1:
             print("  {0:2d} (unused)".format(len(self.elements)))
             print("   :    :")
         if num_unused_elements > 0:
-            print("  {0:2d} (unused)".format(FFFF_HDR_NUM_ELEMENTS-1))
+            print("  {0:2d} (unused)".format(self.layout.num_elements - 1))
 
     def display_element_data(self, header_index):
         # Display the element data (TFTFs) from the element table
@@ -634,14 +669,14 @@ class Ffff:
         for i in range(len(self.reserved)):
             wf.write("{0:s}reserved[{1:d}]  {2:08x}\n".
                      format(prefix, i,
-                            base_offset + FFFF_HDR_OFF_RESERVED +
+                            base_offset + self.layout.off_reserved +
                             (FFFF_RSVD_SIZE * i)))
 
         # Add the element table
         wf.write("{0:s}element_table  {1:08x}\n".
-                 format(prefix, base_offset + FFFF_HDR_OFF_ELEMENT_TBL))
-        element_offset = base_offset + FFFF_HDR_OFF_ELEMENT_TBL
-        for index in range(FFFF_HDR_NUM_ELEMENTS):
+                 format(prefix, base_offset + self.layout.off_element_tbl))
+        element_offset = base_offset + self.layout.off_element_tbl
+        for index in range(self.layout.num_elements):
             wf.write("{0:s}element[{1:d}].type  {2:08x}\n".
                      format(prefix, index,
                             element_offset + FFFF_ELT_OFF_TYPE))
@@ -664,7 +699,7 @@ class Ffff:
 
         # Add the tail sentinel
         wf.write("{0:s}tail_sentinel  {1:08x}\n".
-                 format(prefix, base_offset + FFFF_HDR_OFF_TAIL_SENTINEL))
+                 format(prefix, base_offset + self.layout.off_tail_sentinel))
 
     def write_map_elements(self, wf, base_offset, prefix=""):
         """Display the field names and offsets of a single FFFF header"""
@@ -29,9 +29,11 @@
 #
 
 from __future__ import print_function
-from struct import unpack_from, pack_into
-from tftf import Tftf
-from util import error, block_aligned
+import os
+from struct import Struct
+from threading import Lock
+from tftf import Tftf, TFTF_SECTION_TYPE_END_OF_DESCRIPTORS, TFTF_SENTINEL
+from util import error, block_aligned, buffer_view, write_view
 
 
 # TFTF Sentinel value.
@@ -151,11 +153,75 @@ FFFF_HDR_OFF_TAIL_SENTINEL = (FFFF_HDR_OFF_ELEMENT_TBL +
 
 FFFF_FILE_EXTENSION = ".ffff"
 
+# The value of the unused (padding) bytes in an FFFF: zero by default, or
+# the erased state of NOR flash, which need not be programmed
+FFFF_FILL_DEFAULT = 0x00
+FFFF_FILL_ERASED = 0xff
+
 # TFTF validity assesments
 FFFF_HDR_VALID = 0
 FFFF_HDR_ERASED = 1
 FFFF_HDR_INVALID = 2
 
+# Precompiled element descriptor format (type/class, id, length, location,
+# generation)
+ffff_element_struct = Struct("<LLLLL")
+
+
+class FfffHeaderLayout:
+    """Field layout of an FFFF header of a given size
+
+    Because we have variable-size FFFF headers, the number of entries in
+    the element table, and the offsets to all fields which follow it,
+    depend on the header_size.  A layout captures these (and the
+    precompiled structs to unpack them) for one header_size.  Layouts are
+    shared between Ffff instances and must be treated as read-only; use
+    get_ffff_header_layout() to obtain one.
+    """
+    def __init__(self, header_size):
+        self.header_size = header_size
+
+        # FFFF element table and derived lengths
+        self.num_elements = \
+            ((header_size -
+             (FFFF_HDR_LEN_FIXED_PART + FFFF_HDR_LEN_MIN_RESERVED)) //
+             FFFF_ELT_LENGTH)
+        self.len_element_tbl = self.num_elements * FFFF_ELT_LENGTH
+
+        # The reserved array is always the minimum size, with the element
+        # table immediately following it, and the tail sentinel is always
+        # at the very end of the header (any slack between the element
+        # table and the tail sentinel is unused).  This is the layout of
+        # existing images, and the one the bootrom expects.
+        self.len_reserved = FFFF_HDR_LEN_MIN_RESERVED
+        self.num_reserved = FFFF_HDR_NUM_RESERVED_MIN
+
+        # Offsets to fields following the reserved table
+        self.off_reserved = FFFF_HDR_OFF_RESERVED
+        self.off_element_tbl = self.off_reserved + self.len_reserved
+        self.off_tail_sentinel = header_size - FFFF_HDR_LEN_TAIL_SENTINEL
+
+        # Precompiled formats for the fixed part + reserved table
+        self.header_struct = Struct("<16s16s48sLLLLL" +
+                                    "L" * self.num_reserved)
+        self.reserved_struct = Struct("<" + "L" * self.num_reserved)
+
+
+# Cache of FfffHeaderLayouts, indexed by header_size
+ffff_header_layouts = {}
+ffff_header_layouts_lock = Lock()
+
+
+def get_ffff_header_layout(header_size):
+    """Return the (shared, cached) FfffHeaderLayout for a header_size"""
+    with ffff_header_layouts_lock:
+        layout = ffff_header_layouts.get(header_size)
+        if not layout:
+            layout = FfffHeaderLayout(header_size)
+            ffff_header_layouts[header_size] = layout
+        return layout
+
+
 element_names = {
     FFFF_ELEMENT_END_OF_ELEMENT_TABLE: "end of elements",
     FFFF_ELEMENT_STAGE2_FIRMWARE_PACKAGE: "stage 2 firmware",
@@ -196,6 +262,9 @@ class FfffElement:
         # Private vars
         self.filename = filename
         self.tftf_blob = None
+        # Optional dictionary of element TFTFs, keyed by (location, length),
+        # shared with other elements parsed from the same ROM image
+        self.tftf_cache = None
         self.buf = buf
         self.buf_size = buf_size
         self.index = index
@@ -232,14 +301,14 @@ class FfffElement:
         if self.filename and not self.tftf_blob:
             # Create a TFTF blob and load the contents from the specified
             # TFTF file
-            self.tftf_blob = Tftf(0, self.filename)
+            self.tftf_blob = Tftf(0, None)
             success = self.tftf_blob.load_tftf_file(self.filename)
-            if success and self.tftf_blob.is_good():
-                # element_length must be that of the entire TFTF blob,
-                # not just the TFTF's "load_length" or "expanded_length".
-                self.element_length = self.tftf_blob.tftf_length
-            else:
-                raise ValueError("Bad TFTF file: {0:x}".format(self.filename))
+            if not success or not self.tftf_blob.is_good():
+                raise ValueError("Bad TFTF file: {0:s}".format(self.filename))
+        if self.tftf_blob:
+            # element_length must be that of the entire TFTF blob,
+            # not just the TFTF's "load_length" or "expanded_length".
+            self.element_length = self.tftf_blob.tftf_length
         return True
 
     def unpack(self, buf, offset):
@@ -249,7 +318,7 @@ class FfffElement:
         offset.  Returns a flag indicating if the unpacked element is an
         end-of-table marker
         """
-        element_hdr = unpack_from("<LLLLL", buf, offset)
+        element_hdr = ffff_element_struct.unpack_from(buf, offset)
         type_class = element_hdr[0]
         self.element_type = type_class & 0x000000ff
         self.element_class = (type_class >> 8) & 0x00ffffff
@@ -258,16 +327,11 @@ class FfffElement:
         self.element_location = element_hdr[3]
         self.element_generation = element_hdr[4]
 
-        # Get the element data into our tftf_blob
+        # The element data is left in the buffer, and its TFTF is only
+        # parsed if it is needed (see: get_tftf)
+        self.buf = buf
+        self.tftf_blob = None
         if self.element_type != FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
-            # Create a TFTF blob and load the contents from the specified
-            # TFTF file
-            span_start = self.element_location
-            span_end = span_start + self.element_length
-            self.tftf_blob = Tftf(0, None)
-            span_start = self.element_location
-            span_end = span_start + self.element_length
-            self.tftf_blob.load_tftf_from_buffer(buf[span_start:span_end])
             return False
         else:
             # EOT is always valid
@@ -276,6 +340,41 @@ class FfffElement:
             self.valid_type = True
             return True
 
+    def get_tftf(self):
+        """Return the element's TFTF, parsing it on first use
+
+        An unpacked element's TFTF is parsed in place, from a view into the
+        ROM image buffer, and is shared (via tftf_cache) with any other
+        element covering the same span, such as its twin in the other FFFF
+        header.  Returns None for the end-of-table marker.
+        """
+        if self.tftf_blob is None and \
+           self.element_type != FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
+            key = (self.element_location, self.element_length)
+            if self.tftf_cache is not None:
+                self.tftf_blob = self.tftf_cache.get(key)
+            if self.tftf_blob is None:
+                self.tftf_blob = Tftf(0, None)
+                self.tftf_blob.load_tftf_from_buffer(
+                    buffer_view(self.buf, self.element_location,
+                                self.element_length))
+                if self.tftf_cache is not None:
+                    self.tftf_cache[key] = self.tftf_blob
+        return self.tftf_blob
+
+    def holds_tftf(self):
+        # Determine if the element holds a TFTF (one has been loaded for
+        # it, or its payload starts with the TFTF sentinel), without
+        # parsing its payload
+        if self.tftf_blob is not None:
+            return True
+        if self.element_type == FFFF_ELEMENT_END_OF_ELEMENT_TABLE or \
+           self.element_length < len(TFTF_SENTINEL) or \
+           self.element_location + len(TFTF_SENTINEL) > len(self.buf):
+            return False
+        return str(buffer_view(self.buf, self.element_location,
+                               len(TFTF_SENTINEL))) == TFTF_SENTINEL
+
     def pack(self, buf, offset):
         """Pack an element header into an FFFF header
 
@@ -283,12 +382,12 @@ class FfffElement:
         specified offset and returns the offset for the next element
         """
         type_class = (self.element_class << 8) | self.element_type
-        pack_into("<LLLLL", buf, offset,
-                  type_class,
-                  self.element_id,
-                  self.element_length,
-                  self.element_location,
-                  self.element_generation)
+        ffff_element_struct.pack_into(buf, offset,
+                                      type_class,
+                                      self.element_id,
+                                      self.element_length,
+                                      self.element_location,
+                                      self.element_generation)
         return offset + FFFF_ELT_LENGTH
 
     def validate(self, address_range_low, address_range_high):
@@ -324,25 +423,25 @@ class FfffElement:
             self.element_type <= FFFF_ELEMENT_DATA
         return self.in_range and self.aligned and self.valid_type
 
-    def validate_against(self, other):
-        # Validate an element header against another element header
+    def validate_against(self, locations, duplicates):
+        # Validate an element header against the rest of the element table
+        #
+        # locations is an IntervalIndex of the element spans, and duplicates
+        # is the find_duplicates() map of element identities (type, ID,
+        # generation), both keyed by element index.
 
         # Check for collision
-        start_a = self.element_location
-        end_a = start_a + self.element_length - 1
-        start_b = other.element_location
-        end_b = start_b + other.element_length - 1
-        if end_b >= start_a and start_b <= end_a:
-            self.collisions += [other.index]
+        self.collisions = \
+            [index for index in
+             locations.find_range(self.element_location,
+                                  self.element_location + self.element_length)
+             if index != self.index]
 
         # Check for other duplicate entries per the specification:
         # "At most, one element table entry with a particular element
         # type, element ID, and element generation may be present in
         # the element table."
-        if self.element_type == other.element_type and \
-           self.element_id == other.element_id and \
-           self.element_generation == other.element_generation:
-            self.duplicates += [other.index]
+        self.duplicates = duplicates.get(self.index, [])
 
     def same_as(self, other):
         """Determine if this TFTF is identical to another"""
@@ -362,11 +461,71 @@ class FfffElement:
         """
 
         # Output the entire FFFF element blob (less padding)
-        with open(filename, 'wb') as wf:
-            wf.write(self.buf[self.element_location:
-                              self.element_location +
-                              self.element_length])
-            print("Wrote", filename)
+        write_view(filename, self.buf, self.element_location,
+                   self.element_length)
+        print("Wrote", filename)
+
+    def explode(self, directory):
+        """Describe the files an element explodes into
+
+        Returns the element's entry for an exploded FFFF's index (see:
+        FfffRomimage.explode_tree) and the list of (filename, offset,
+        length) ranges of the ROM image buffer to write: the element in
+        <directory>/element.bin and, if it holds a good TFTF, the TFTF
+        header in tftf_header.bin and each section's payload in
+        section_<nn>_<type>.bin.  Filenames are relative to the root of
+        the exploded FFFF.
+        """
+        extracts = [(os.path.join(directory, "element.bin"),
+                     self.element_location, self.element_length)]
+        entry = {"index": self.index,
+                 "type": self.element_type,
+                 "type_name": self.element_name(self.element_type),
+                 "class": self.element_class,
+                 "id": self.element_id,
+                 "generation": self.element_generation,
+                 "location": self.element_location,
+                 "length": self.element_length,
+                 "file": extracts[0][0],
+                 "tftf": None}
+
+        # Explode the TFTF, unless it's bad or runs beyond the element
+        tftf = self.get_tftf()
+        if not tftf or not tftf.is_good() or \
+           tftf.get_section_offset(len(tftf.sections)) > self.element_length:
+            return entry, extracts
+        header_file = os.path.join(directory, "tftf_header.bin")
+        extracts.append((header_file, self.element_location,
+                         tftf.header_size))
+        sections = []
+        for index, section in enumerate(tftf.sections):
+            if section.section_type == TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
+                break
+            filename = os.path.join(directory, "section_{0:02d}_{1:s}.bin".
+                                    format(index, section.section_short_name(
+                                           section.section_type)))
+            offset = self.element_location + tftf.get_section_offset(index)
+            extracts.append((filename, offset, section.section_length))
+            sections.append({"index": index,
+                             "type": section.section_type,
+                             "type_name": section.section_name(
+                                 section.section_type),
+                             "class": section.section_class,
+                             "id": section.section_id,
+                             "load_address": section.load_address,
+                             "expanded_length": section.expanded_length,
+                             "offset": offset,
+                             "length": section.section_length,
+                             "file": filename})
+        entry["tftf"] = {"name": tftf.firmware_package_name.rstrip("\0").
+                         decode("latin-1"),
+                         "timestamp": tftf.timestamp.rstrip("\0").
+                         decode("latin-1"),
+                         "header_size": tftf.header_size,
+                         "start_location": tftf.start_location,
+                         "header_file": header_file,
+                         "sections": sections}
+        return entry, extracts
 
     def element_name(self, element_type):
         # Convert an element type into textual form
@@ -406,13 +565,13 @@ class FfffElement:
         # Note any collisions and duplicates on separate lines
         if len(self.collisions) > 0:
             element_string = "           Collides with element(s):"
-            for collision in self.collisions[self.index]:
+            for collision in self.collisions:
                 element_string += " {0:d}".format(collision)
             print(element_string)
 
         if len(self.duplicates) > 0:
             element_string = "           Duplicates element(s):"
-            for duplicate in self.duplicates[self.index]:
+            for duplicate in self.duplicates:
                 element_string += " {0:d}".format(duplicate)
             print(element_string)
 
@@ -432,10 +591,12 @@ class FfffElement:
 
         Print an element header's TFTF info
         """
-        if self.element_type != FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
-            self.tftf_blob.display("element [{0:d}]".format(self.index), "  ")
-            self.tftf_blob.display_data("element [{0:d}]".
-                                        format(self.index), "  ")
+        if self.holds_tftf():
+            tftf = self.get_tftf()
+            tftf.display("element [{0:d}]".format(self.index), "  ")
+            tftf.display_data("element [{0:d}]".format(self.index), "  ")
+        elif self.element_type != FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
+            print("  element [{0:d}] is not a TFTF".format(self.index))
 
     def write_map_payload(self, wf,  base_offset, prefix=""):
         """Display the field names and offsets of a single FFFF header"""
@@ -444,9 +605,9 @@ class FfffElement:
                           self.element_short_name(self.element_type))
 
         # Dump the element starts
-        if self.tftf_blob:
+        if self.holds_tftf():
             # We've got a TFTF, pass that on to TFTF to display
-            self.tftf_blob.write_map(wf, self.element_location, elt_name)
+            self.get_tftf().write_map(wf, self.element_location, elt_name)
         elif self.element_type != FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
             # Just print the element payload location
             wf.write("{0:s}  {1:08x}\n".
@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+
+#
+# Copyright (c) 2015 Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Automatic FFFF layout: header sizing and element placement"""
+
+from __future__ import print_function
+from ffff_element import FFFF_HDR_LEN_FIXED_PART, FFFF_HDR_LEN_MIN_RESERVED, \
+    FFFF_ELT_LENGTH, FFFF_HEADER_SIZE_MIN, FFFF_HEADER_SIZE_MAX, \
+    get_ffff_header_layout
+from ffff import get_header_block_size
+from util import next_boundary
+
+
+def get_smallest_header_size(num_elements):
+    """Return the smallest FFFF header size which holds num_elements
+
+    (The element table also needs room for the end-of-table marker.)
+    Raises ValueError if no header size is big enough.
+    """
+    header_size = FFFF_HDR_LEN_FIXED_PART + FFFF_HDR_LEN_MIN_RESERVED + \
+        (num_elements + 1) * FFFF_ELT_LENGTH
+    header_size = max(FFFF_HEADER_SIZE_MIN, next_boundary(header_size, 4))
+    if header_size > FFFF_HEADER_SIZE_MAX:
+        raise ValueError("{0:d} elements won't fit in an FFFF header".
+                         format(num_elements))
+    assert get_ffff_header_layout(header_size).num_elements > num_elements
+    return header_size
+
+
+class FfffLayout:
+    """The placement of a set of elements in an FFFF ROM image
+
+    Elements occupy whole erase blocks.  Pinned elements (those with a
+    non-zero location) stay where they are; the rest are placed largest
+    first, each in the lowest suitably-aligned gap that will hold it
+    (first-fit decreasing), which keeps the image short and leaves as few
+    unused blocks between elements as it can.
+    """
+    def __init__(self, erase_block_size, header_size, image_length=0,
+                 alignment=0):
+        """Layout constructor
+
+        image_length of 0 means the image is made just long enough for the
+        elements, and alignment of 0 means erase-block alignment.
+        """
+        self.erase_block_size = erase_block_size
+        self.header_size = header_size
+        self.header_block_size = get_header_block_size(erase_block_size,
+                                                       header_size)
+        self.image_length = image_length
+        self.alignment = alignment or erase_block_size
+        if self.alignment % erase_block_size != 0:
+            raise ValueError("The element alignment must be a multiple of "
+                             "the erase block size")
+        self.element_min = 2 * self.header_block_size
+        self.lengths = []
+        self.locations = []
+
+    def get_span(self, index):
+        # Return the (start, end) of the blocks an element occupies
+        start = self.locations[index]
+        return (start, next_boundary(start + self.lengths[index],
+                                     self.erase_block_size))
+
+    def find_gap(self, spans, size):
+        # Return the lowest aligned location, above the headers and clear
+        # of the (sorted) spans, with room for size bytes
+        location = next_boundary(self.element_min, self.alignment)
+        for start, end in spans:
+            if location + size <= start:
+                break
+            location = max(location, next_boundary(end, self.alignment))
+        return location
+
+    def place(self, lengths, locations):
+        """Place the elements, returning their locations
+
+        lengths and locations are lists (in element table order), with a
+        location of 0 for elements to be placed.  Raises ValueError if the
+        pinned elements collide or the elements don't fit.
+        """
+        self.lengths = list(lengths)
+        self.locations = list(locations)
+        pinned = [index for index, location in enumerate(self.locations)
+                  if location != 0]
+        unplaced = [index for index, location in enumerate(self.locations)
+                    if location == 0]
+
+        spans = sorted(self.get_span(index) for index in pinned)
+        for (start, end), (next_start, _) in zip(spans, spans[1:]):
+            if end > next_start:
+                raise ValueError("Pinned elements at {0:#x} and {1:#x} "
+                                 "overlap".format(start, next_start))
+        if spans and spans[0][0] < self.element_min:
+            raise ValueError("Pinned element at {0:#x} overlaps the FFFF "
+                             "headers".format(spans[0][0]))
+
+        # Largest first (and in table order among equals)
+        unplaced.sort(key=lambda index: -self.lengths[index])
+        for index in unplaced:
+            size = next_boundary(self.lengths[index], self.erase_block_size)
+            self.locations[index] = self.find_gap(spans, size)
+            spans.append(self.get_span(index))
+            spans.sort()
+
+        end = max([self.element_min] + [end for _, end in spans])
+        if self.image_length == 0:
+            self.image_length = end
+        elif end > self.image_length:
+            raise ValueError("The elements need an image length of at least "
+                             "{0:#x}".format(end))
+        return self.locations
+
+    def get_gaps(self):
+        """Return the (start, end) runs of unused blocks between the
+        headers and the end of the image"""
+        gaps = []
+        location = self.element_min
+        spans = sorted(self.get_span(index)
+                       for index in range(len(self.locations)))
+        for start, end in spans + [(self.image_length, self.image_length)]:
+            if start > location:
+                gaps.append((location, start))
+            location = max(location, end)
+        return gaps
+
+    def display(self, names=None, flash_capacity=0):
+        """Print the layout and its slack
+
+        names are optional element names, in element table order.
+        """
+        print("FFFF layout: header size 0x{0:x}, header blocks 2 x 0x{1:x}, "
+              "image length 0x{2:x}".format(self.header_size,
+                                           self.header_block_size,
+                                           self.image_length))
+        tail_slack = 0
+        for index in sorted(range(len(self.locations)),
+                            key=lambda index: self.locations[index]):
+            start, end = self.get_span(index)
+            slack = end - (start + self.lengths[index])
+            tail_slack += slack
+            name = names[index] if names else ""
+            print("  element [{0:d}] 0x{1:08x}-0x{2:08x} length 0x{3:08x} "
+                  "slack 0x{4:05x} {5:s}".format(index, start, end,
+                                                 self.lengths[index], slack,
+                                                 name))
+        gaps = self.get_gaps()
+        gap_length = sum(end - start for start, end in gaps)
+        for start, end in gaps:
+            print("  unused     0x{0:08x}-0x{1:08x} ({2:d} blocks)".format(
+                  start, end, (end - start) // self.erase_block_size))
+        print("Slack:")
+        print("  Header blocks:      0x{0:08x}".format(
+              2 * (self.header_block_size - self.header_size)))
+        print("  Element tails:      0x{0:08x}".format(tail_slack))
+        print("  Unused blocks:      0x{0:08x}".format(gap_length))
+        if flash_capacity:
+            print("  Flash beyond image: 0x{0:08x}".format(
+                  max(0, flash_capacity - self.image_length)))
@@ -32,14 +32,82 @@ from __future__ import print_function
 from string import rfind
 from struct import unpack_from
 from ffff_element import FFFF_MAX_HEADER_BLOCK_OFFSET, FFFF_SENTINEL, \
-    FFFF_HDR_OFF_TAIL_SENTINEL, \
     FFFF_FILE_EXTENSION, FFFF_HDR_VALID, \
     FFFF_HEADER_SIZE_MIN, FFFF_HEADER_SIZE_MAX, FFFF_HEADER_SIZE_DEFAULT, \
-    FFFF_HDR_LEN_FIXED_PART, FFFF_ELT_LENGTH, \
-    FFFF_RSVD_SIZE, FFFF_HDR_OFF_RESERVED
+    FFFF_FILL_DEFAULT, FFFF_FILL_ERASED, FFFF_ELEMENT_END_OF_ELEMENT_TABLE, \
+    FFFF_ELT_LENGTH, get_ffff_header_layout
 from ffff import Ffff, get_header_block_size
-from util import is_power_of_2
+from tftf import Tftf
+from interval_index import IntervalIndex
+from util import is_power_of_2, get_timestamp, get_fill_byte, buffer_view, \
+    copy_into, write_view, create_file, unshare_file
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import io
+import os
+import json
+import mmap
+
+# Erase-block occupancy classes (see: FfffRomimage.get_occupancy), each
+# the character representing it in an occupancy map
+BLOCK_HEADER = "H"
+BLOCK_ELEMENT = "E"
+BLOCK_ZEROED = "0"
+BLOCK_ERASED = "F"
+BLOCK_STRAY = "X"
+BLOCK_CLASS_NAMES = ((BLOCK_HEADER, "FFFF header"),
+                     (BLOCK_ELEMENT, "element"),
+                     (BLOCK_ZEROED, "all 0x00"),
+                     (BLOCK_ERASED, "all 0xff (erased)"),
+                     (BLOCK_STRAY, "stray data"))
+
+# The number of erase blocks per line of an occupancy map
+OCCUPANCY_MAP_WIDTH = 64
+
+# The index of an exploded FFFF (see: FfffRomimage.explode_tree), and the
+# version of its format
+EXPLODE_INDEX_FILENAME = "index.json"
+EXPLODE_INDEX_VERSION = 1
+
+
+def load_element_source(filename):
+    """Load and validate an element's TFTF file, returning the Tftf
+
+    Raises ValueError if the file can't be loaded or isn't a good TFTF.
+    """
+    tftf = Tftf(0, None)
+    if not tftf.load_tftf_file(filename) or not tftf.is_good():
+        raise ValueError("Bad TFTF file: {0:s}".format(filename))
+    return tftf
+
+
+def load_element_sources(filenames, jobs=None, element_sources=None):
+    """Load and validate a set of element TFTF files, concurrently
+
+    Returns a dictionary of the loaded Tftfs, keyed by filename: the
+    element_sources dictionary, if given, with any files it lacks added.
+    Each file is loaded just once, however many times it is named, "jobs"
+    files at a time (default: the number of CPUs).  Raises ValueError if
+    any file isn't a good TFTF.
+    """
+    if element_sources is None:
+        element_sources = {}
+    filenames = sorted(set(filename for filename in filenames
+                           if filename and filename not in element_sources))
+    if not filenames:
+        return element_sources
+    jobs = min(jobs or cpu_count(), len(filenames))
+    if jobs == 1:
+        tftfs = [load_element_source(f) for f in filenames]
+    else:
+        pool = ThreadPool(jobs)
+        try:
+            tftfs = pool.map(load_element_source, filenames)
+        finally:
+            pool.close()
+            pool.join()
+    element_sources.update(zip(filenames, tftfs))
+    return element_sources
 
 
 # FFFF ROMimage representation (2x FFFF headers + Nx TFTF blobs)
@@ -48,17 +116,28 @@ class FfffRomimage:
 
     # FFFF constructor
     #
-    def __init__(self):
+    def __init__(self, element_sources=None):
         """FFFF ROMimage constructor
 
         The FFFF representation contains a buffer of the ROM span covered by
-        the image.
+        the image.  element_sources optionally supplies element TFTFs which
+        have already been loaded (see: load_element_sources), e.g. to
+        share them among several FFFFs.
         """
         # FFFF header fields
         self.header_size = FFFF_HEADER_SIZE_DEFAULT
+        self.layout = get_ffff_header_layout(self.header_size)
         self.ffff0 = None
         self.ffff1 = None
         self.ffff_buf = None
+        self.ffff_map = None
+        self.out_filename = None
+        self.fill_byte = FFFF_FILL_DEFAULT
+        # The loaded element TFTFs, keyed by filename and shared by both
+        # FFFF headers (see: load_element_sources)
+        if element_sources is None:
+            element_sources = {}
+        self.element_sources = element_sources
         self.mv = None
         self.flash_image_name = None
         self.flash_capacity = 0
@@ -69,13 +148,25 @@ class FfffRomimage:
         self.element_location_max = 0
 
     def init(self, flash_image_name, flash_capacity, erase_block_size,
-             image_length, header_generation_number, header_size):
+             image_length, header_generation_number, header_size,
+             out_filename=None, fill_byte=FFFF_FILL_DEFAULT):
         """"FFFF post-constructor initializer for a new FFFF
 
         FFFF post-constructor initializer for creating an FFFF (as opposed
         to reading an existing one from a file), and returns a success flag.
         The FFFF ROMimage buffer is sized explicitly from the image_length
         parameter.
+
+        If out_filename is given, the ROMimage is built directly in that
+        file (sized to image_length, and mapped) rather than in memory.
+        Only the header blocks and element spans are ever written, so on
+        filesystems which support them, the rest of the file is left as
+        holes.  write() must then be given the same filename.
+
+        Everything outside the headers and elements is set to fill_byte:
+        FFFF_FILL_ERASED leaves it in the erased state of NOR flash, so
+        that flash programmers can skip it.  (A sparse file can only have
+        holes where the fill is zero.)
         """
         # Validate the parameters
         if (header_size < FFFF_HEADER_SIZE_MIN) or \
@@ -86,6 +177,8 @@ class FfffRomimage:
         elif (image_length % erase_block_size) != 0:
             raise ValueError("Image length must be a multiple "
                              "of erase bock size")
+        elif fill_byte < 0 or fill_byte > 0xff:
+            raise ValueError("fill_byte is out of range")
 
         self.header_size = header_size
         self.flash_image_name = flash_image_name
@@ -93,13 +186,32 @@ class FfffRomimage:
         self.erase_block_size = erase_block_size
         self.flash_image_length = image_length
         self.header_generation_number = header_generation_number
+        self.fill_byte = fill_byte
 
         # Determine the ROM range that can hold the elements
         self.element_location_min = 2 * self.get_header_block_size()
         self.element_location_max = image_length
 
-        # Resize the ROMimage buffer to the correct size
-        self.ffff_buf = bytearray(image_length)
+        if out_filename:
+            # Build the ROMimage in a sparse file of the correct size (a
+            # new file, so that any hard links to an existing output are
+            # left alone)
+            try:
+                with create_file(out_filename, 'w+b') as wf:
+                    wf.truncate(image_length)
+                    self.ffff_map = mmap.mmap(wf.fileno(), image_length,
+                                              access=mmap.ACCESS_WRITE)
+            except (EnvironmentError, mmap.error):
+                raise IOError("can't create {0:s}".format(out_filename))
+            self.ffff_buf = self.ffff_map
+            self.out_filename = out_filename
+            if fill_byte != 0:
+                fill = chr(fill_byte) * erase_block_size
+                for offset in range(0, image_length, erase_block_size):
+                    self.ffff_map[offset:offset + erase_block_size] = fill
+        else:
+            # Resize the ROMimage buffer to the correct size
+            self.ffff_buf = bytearray(chr(fill_byte)) * image_length
         #self.mv = memoryview(self.ffff_buf)
 
         # Create the 2 FFFF headers
@@ -119,14 +231,25 @@ class FfffRomimage:
                           image_length,
                           header_generation_number,
                           header_size)
+        self.ffff0.fill_byte = fill_byte
+        self.ffff1.fill_byte = fill_byte
         return True
 
-    def init_from_file(self, filename):
+    def init_from_file(self, filename, lazy=False, writable=False):
         """"FFFF post-constructor initializer to read an FFFF from file
 
         Distinct from "init" above, this reads in an existing FFFF file
         and parses it, returning a success flag. The FFFF ROMimage buffer
         is sized to the supplied file.
+
+        If lazy is True, the file is mapped (copy-on-write) rather than
+        read, so that only the pages actually examined (typically just the
+        header blocks) are read from disk.  Element TFTFs are parsed on
+        demand in either case.  Call close() to release the mapping.
+
+        If writable is True, the file is mapped shared (as if lazy), so
+        that changes to the ROMimage (see: replace_element) are made
+        directly to the file.
         """
         if filename:
             # Try to open the file, and if that fails, try appending the
@@ -135,7 +258,9 @@ class FfffRomimage:
             rf = None
             for i in range(len(names)):
                 try:
-                    rf = io.open(names[i], 'rb')
+                    if writable:
+                        unshare_file(names[i])
+                    rf = io.open(names[i], 'r+b' if writable else 'rb')
                     break
                 except:
                     rf = None
@@ -148,12 +273,24 @@ class FfffRomimage:
                 rf.seek(0, 2)
                 read_size = rf.tell()
 
-                # Resize the buffer to hold the file
-                self.ffff_buf = bytearray(read_size)
-                rf.seek(0, 0)
-                rf.readinto(self.ffff_buf)
+                if writable and read_size > 0:
+                    # Map the file for updating in place
+                    self.ffff_map = mmap.mmap(rf.fileno(), 0,
+                                              access=mmap.ACCESS_WRITE)
+                    self.ffff_buf = self.ffff_map
+                elif lazy and read_size > 0:
+                    # Map the file; writes (e.g., re-packing the headers)
+                    # go to private pages and never reach the file
+                    self.ffff_map = mmap.mmap(rf.fileno(), 0,
+                                              access=mmap.ACCESS_COPY)
+                    self.ffff_buf = self.ffff_map
+                else:
+                    # Resize the buffer to hold the file
+                    self.ffff_buf = bytearray(read_size)
+                    rf.seek(0, 0)
+                    rf.readinto(self.ffff_buf)
                 rf.close()
-            except IOError:
+            except (IOError, mmap.error):
                 raise IOError("can't read {0:s}".format(filename))
 
             self.get_romimage_characteristics()
@@ -167,6 +304,9 @@ class FfffRomimage:
                               self.flash_image_length,
                               self.header_generation_number,
                               0)
+            # We don't know how the image was filled, so accept either a
+            # zero or an erased fill
+            self.ffff0.fill_byte = FFFF_FILL_ERASED
             self.ffff0.unpack()
 
             # Scan for 2nd header
@@ -178,7 +318,7 @@ class FfffRomimage:
                 nose_sentinel = ffff_hdr[0]
                 ffff_hdr = unpack_from("<16s", self.ffff_buf,
                                        offset +
-                                       FFFF_HDR_OFF_TAIL_SENTINEL)
+                                       self.layout.off_tail_sentinel)
                 tail_sentinel = ffff_hdr[0]
 
                 # Create the 2nd FFFF header/object?
@@ -191,6 +331,10 @@ class FfffRomimage:
                                       self.flash_image_length,
                                       self.header_generation_number,
                                       0)
+                    # Both headers normally describe the same elements, so
+                    # let them share the parsed element TFTFs
+                    self.ffff1.element_tftfs = self.ffff0.element_tftfs
+                    self.ffff1.fill_byte = FFFF_FILL_ERASED
                     self.ffff1.unpack()
                     break
                 else:
@@ -206,31 +350,14 @@ class FfffRomimage:
         return get_header_block_size(self.erase_block_size, self.header_size)
 
     def recalculate_header_offsets(self):
-        """ Recalculate element table size and offsets from header_size
+        """ Select the header layout matching header_size
 
-        Because we have variable-size FFFF headers, we need to recalculate the
-        number of entries in the section table, and the offsets to all fields
-        which follow.
+        Because we have variable-size FFFF headers, the number of entries in
+        the element table, and the offsets to all fields which follow, depend
+        on the header size (see: FfffHeaderLayout).
         """
-        global FFFF_HDR_NUM_ELEMENTS, FFFF_HDR_LEN_ELEMENT_TBL, \
-            FFFF_HDR_NUM_RESERVED, FFFF_HDR_LEN_RESERVED, \
-            FFFF_HDR_OFF_RESERVED, FFFF_RSVD_SIZE, FFFF_HDR_OFF_TAIL_SENTINEL
-        # TFTF section table and derived lengths
-        FFFF_HDR_NUM_ELEMENTS = \
-            ((self.header_size - FFFF_HDR_LEN_FIXED_PART) // FFFF_ELT_LENGTH)
-        FFFF_HDR_LEN_ELEMENT_TBL = (FFFF_HDR_NUM_ELEMENTS * FFFF_ELT_LENGTH)
-
-        FFFF_HDR_LEN_RESERVED = (self.header_size -
-                                (FFFF_HDR_LEN_FIXED_PART +
-                                 FFFF_HDR_LEN_ELEMENT_TBL))
-        FFFF_HDR_NUM_RESERVED = FFFF_HDR_LEN_RESERVED / FFFF_RSVD_SIZE
-        self.reserved = [0] * FFFF_HDR_NUM_RESERVED
-
-        # Offsets to fields following the section table
-        FFFF_HDR_OFF_ELEMENT_TBL = (FFFF_HDR_OFF_RESERVED +
-                                    FFFF_HDR_LEN_RESERVED)
-        FFFF_HDR_OFF_TAIL_SENTINEL = (FFFF_HDR_OFF_ELEMENT_TBL +
-                                      FFFF_HDR_LEN_ELEMENT_TBL)
+        self.layout = get_ffff_header_layout(self.header_size)
+        self.reserved = [0] * self.layout.num_reserved
 
     def get_romimage_characteristics(self):
         # Extract the ROMimage size and characteritics from the first FFFF
@@ -250,11 +377,14 @@ class FfffRomimage:
         # Because we have variable-size FFFF headers, we need to recalculate
         # the number of entries in the section table, and the offsets to all
         # fields which follow.
+        if (self.header_size < FFFF_HEADER_SIZE_MIN) or \
+           (self.header_size > FFFF_HEADER_SIZE_MAX):
+            raise ValueError("header_size is out of range")
         self.recalculate_header_offsets()
 
         # Unpack the 2nd sentinel at the tail
         ffff_hdr = unpack_from("<16s", self.ffff_buf,
-                               FFFF_HDR_OFF_TAIL_SENTINEL)
+                               self.layout.off_tail_sentinel)
         tail_sentinel = ffff_hdr[0]
 
         # Verify the sentinels
@@ -272,13 +402,25 @@ class FfffRomimage:
         self.element_location_min = 2 * self.get_header_block_size()
         self.element_location_max = self.flash_capacity
 
+    def load_element_sources(self, filenames, jobs=None):
+        """Load and validate a set of element TFTF files, concurrently
+
+        Each file is loaded just once, however many times it is named, and
+        is then shared by both FFFF headers (see: add_element).  Raises
+        ValueError if any file isn't a good TFTF.
+        """
+        load_element_sources(filenames, jobs, self.element_sources)
+
     def add_element(self, element_type, element_class, element_id,
                     element_length, element_location, element_generation,
                     filename):
-        # Add a new element to the element table but don't load the
-        # TFTF file into the ROMimage buffer.  This is called for FFFF
-        # creation, and adds the element to both FFFF headers.
+        # Add a new element to the element table of both FFFF headers.  This
+        # is called for FFFF creation.  The element's TFTF file is loaded
+        # (unless load_element_sources already did so) and copied into the
+        # ROMimage buffer (which is common to both headers) just once.
         if self.ffff0 and self.ffff1:
+            self.load_element_sources([filename])
+            tftf_blob = self.element_sources.get(filename)
             return \
                 self.ffff0.add_element(element_type,
                                        element_class,
@@ -286,58 +428,200 @@ class FfffRomimage:
                                        element_length,
                                        element_location,
                                        element_generation,
-                                       filename) and \
+                                       filename,
+                                       tftf_blob) and \
                 self.ffff1.add_element(element_type,
                                        element_class,
                                        element_id,
                                        element_length,
                                        element_location,
                                        element_generation,
-                                       filename)
+                                       filename,
+                                       tftf_blob,
+                                       copy_data=False)
         else:
             raise ValueError("No FFFF in which to add element")
 
+    def replace_element(self, index, filename, generation=None,
+                        fill_byte=FFFF_FILL_DEFAULT):
+        """Replace an element's TFTF in place
+
+        Writes the TFTF in filename over element [index], and updates the
+        element's length (and generation, if given) in both FFFF headers.
+        Whatever the old element occupied beyond the end of the new one is
+        set to fill_byte.  Only the affected interval is revalidated.  The
+        new element may grow into unused space, but not into another
+        element or past the end of the image, and its identity must stay
+        unique.  Only the element's span and its two element descriptors
+        are written, so the rest of the image is untouched.
+
+        Returns the sorted list of (start, end) byte ranges written.
+        Raises ValueError if the element can't be replaced.
+        """
+        if not (self.ffff0 and self.ffff1):
+            raise ValueError("No FFFF in which to replace an element")
+        if index < 0 or index >= len(self.ffff0.elements) or \
+           self.ffff0.elements[index].element_type == \
+           FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
+            raise ValueError("There is no element [{0:d}]".format(index))
+
+        # Find the element and its twin in the other header
+        element = self.ffff0.elements[index]
+        identity = (element.element_type, element.element_class,
+                    element.element_id, element.element_generation,
+                    element.element_location, element.element_length)
+        twins = [other for other in self.ffff1.elements
+                 if (other.element_type, other.element_class,
+                     other.element_id, other.element_generation,
+                     other.element_location, other.element_length) ==
+                 identity]
+        if not twins:
+            raise ValueError("Element [{0:d}] isn't in both FFFF headers".
+                             format(index))
+        targets = ((self.ffff0, element), (self.ffff1, twins[0]))
+
+        # Check the new span (and identity) against the other elements
+        tftf = load_element_source(filename)
+        location = element.element_location
+        end = location + tftf.tftf_length
+        if end > min(self.flash_image_length, len(self.ffff_buf)):
+            raise ValueError("{0:s} doesn't fit before the end of the image".
+                             format(filename))
+        if generation is None:
+            generation = element.element_generation
+        spans = IntervalIndex()
+        for ffff in (self.ffff0, self.ffff1):
+            for other in ffff.elements:
+                if other.element_type == FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
+                    break
+                if other is element or other is twins[0]:
+                    continue
+                spans.add(other.element_location, other.element_length,
+                          other.index)
+                if (other.element_type, other.element_id,
+                        other.element_generation) == \
+                   (element.element_type, element.element_id, generation):
+                    raise ValueError("Element [{0:d}] would duplicate "
+                                     "element [{1:d}]".format(index,
+                                                              other.index))
+        collisions = sorted(set(spans.find_range(location, end)))
+        if collisions:
+            raise ValueError("{0:s} would overlap element(s) {1:s}".format(
+                filename, ", ".join("[{0:d}]".format(i) for i in collisions)))
+
+        # Write the new element, and blank any leftover of the old one
+        copy_into(self.ffff_buf, location, tftf.tftf_buf)
+        old_end = location + element.element_length
+        if old_end > end:
+            copy_into(self.ffff_buf, end, chr(fill_byte) * (old_end - end))
+        written = [(location, max(end, old_end))]
+
+        # Update the element descriptors
+        for ffff, target in targets:
+            target.element_length = tftf.tftf_length
+            target.element_generation = generation
+            target.tftf_blob = None
+            offset = ffff.header_offset + ffff.layout.off_element_tbl + \
+                target.index * FFFF_ELT_LENGTH
+            target.pack(self.ffff_buf, offset)
+            written.append((offset, offset + FFFF_ELT_LENGTH))
+        if self.ffff_map:
+            self.ffff_map.flush()
+        return sorted(written)
+
+    def set_timestamp(self, timestamp):
+        """Set the timestamp of both FFFF headers
+
+        timestamp is a "YYYYMMDD HHMMSS" string (see: util.get_timestamp).
+        Takes effect when the headers are next packed (e.g., by
+        post_process).
+        """
+        if self.ffff0 and self.ffff1:
+            self.ffff0.timestamp = timestamp
+            self.ffff1.timestamp = timestamp
+        else:
+            raise ValueError("No FFFF to timestamp")
+
     def post_process(self):
         """Post-process the FFFF header
 
         Reads the TFTF files into the ROMimage buffer for both FFFF headers.
+        Both headers get the same timestamp: the current time (or
+        $SOURCE_DATE_EPOCH) unless set with set_timestamp.
         (Called by "create-ffff" after processing all arguments)
+        Raises ValueError if an element runs past the end of the image.
         """
         if self.ffff0 and self.ffff1:
+            if not (self.ffff0.timestamp and self.ffff1.timestamp):
+                self.set_timestamp(self.ffff0.timestamp or
+                                   self.ffff1.timestamp or get_timestamp())
             self.ffff0.post_process(self.mv)
             self.ffff1.post_process(self.mv)
         else:
             raise ValueError("No FFFF to post-process")
 
-    def display(self, header_index, filename=None):
-        """Display an FFFF header"""
+    def display(self, header_index, filename=None, element_data=True):
+        """Display an FFFF header
+
+        The elements' TFTF headers are only displayed (and parsed) if
+        element_data is True.
+        """
 
         if self.ffff0 and self.ffff1:
             identical = self.ffff0.same_as(self.ffff1)
-            self.ffff0.display(0, not identical, identical, filename)
-            self.ffff1.display(1, True, identical, filename)
+            self.ffff0.display(0, element_data and not identical, identical,
+                               filename)
+            self.ffff1.display(1, element_data, identical, filename)
         else:
             raise ValueError("No FFFF to display")
 
+    def close(self):
+        """Release the file mapping of a lazily-loaded FFFF, if any
+
+        (For an FFFF being built in its output file, use write.)
+        """
+        if self.ffff_map:
+            self.ffff_map.close()
+            self.ffff_map = None
+
+    def discard(self):
+        """Abandon an FFFF being built in its output file, deleting it"""
+        if self.out_filename:
+            self.close()
+            os.remove(self.out_filename)
+            self.out_filename = None
+
     def write(self, out_filename):
         """Create the FFFF file
 
         Create the FFFF file, write the FFFF ROMimage buffer to it and return
         a success flag.  Appends the default FFFF file extension if omitted
         """
-        # Reject the write if we didn't pass the sniff test
-        if self.ffff0.header_validity != FFFF_HDR_VALID:
-            raise ValueError("Invalid FFFF header 0")
-        if self.ffff1.header_validity != FFFF_HDR_VALID:
-            raise ValueError("Invalid FFFF header 1")
+        # Reject the write if we didn't pass the sniff test (discarding
+        # the partially-built file if we were building in place)
+        for index, ffff in enumerate((self.ffff0, self.ffff1)):
+            if ffff.header_validity != FFFF_HDR_VALID:
+                self.discard()
+                raise ValueError("Invalid FFFF header {0:d}".format(index))
 
         # Ensure the output file ends in the default file extension if
         # the user hasn't specified their own extension.
         if rfind(out_filename, ".") == -1:
             out_filename += FFFF_FILE_EXTENSION
 
+        if self.out_filename:
+            # The FFFF was built in place, so just flush it out
+            if out_filename != self.out_filename:
+                raise ValueError("FFFF is being built in {0:s}".
+                                 format(self.out_filename))
+            self.ffff_map.flush()
+            self.close()
+            self.out_filename = None
+            print("Wrote", out_filename)
+            return True
+
         # Output the entire FFFF blob
-        with open(out_filename, 'wb') as wf:
+        with create_file(out_filename) as wf:
             wf.write(self.ffff_buf)
             print("Wrote", out_filename)
             return True
@@ -357,6 +641,129 @@ class FfffRomimage:
             self.ffff0.write_elements(root_filename + "_0")
             self.ffff1.write_elements(root_filename + "_1")
 
+    def explode_tree(self, directory, filename=None, jobs=None):
+        """Explode the ROMimage into a directory tree
+
+        Each FFFF header (just one, if they're identical) is written to a
+        subdirectory (ffff, or ffff_0 and ffff_1), along with each of its
+        elements, each element's TFTF header and each section's payload
+        (see: Ffff.explode), and the lot is described by index.json.  The
+        files are written straight from the ROM image buffer (which for a
+        lazily-loaded FFFF is the mapped file), "jobs" at a time (default:
+        the number of CPUs).  Returns the number of files written.
+        """
+        if self.ffff0.same_as(self.ffff1):
+            headers = [("ffff", [0, 1], self.ffff0)]
+        else:
+            headers = [("ffff_0", [0], self.ffff0),
+                       ("ffff_1", [1], self.ffff1)]
+        index = {"format_version": EXPLODE_INDEX_VERSION,
+                 "source": filename,
+                 "flash_image_name": self.ffff0.flash_image_name.
+                 rstrip("\0").decode("latin-1"),
+                 "flash_capacity": self.flash_capacity,
+                 "erase_block_size": self.erase_block_size,
+                 "image_length": self.flash_image_length,
+                 "headers": []}
+        extracts = []
+        for subdirectory, header_indexes, ffff in headers:
+            entry, header_extracts = ffff.explode(subdirectory)
+            entry["headers"] = header_indexes
+            index["headers"].append(entry)
+            extracts += header_extracts
+
+        # Create the directories, then write the files concurrently
+        for subdirectory in sorted(set(os.path.dirname(extract[0])
+                                       for extract in extracts)):
+            path = os.path.join(directory, subdirectory)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        def write_extract(extract):
+            write_view(os.path.join(directory, extract[0]), self.ffff_buf,
+                       extract[1], extract[2])
+
+        jobs = min(jobs or cpu_count(), len(extracts))
+        if jobs == 1:
+            for extract in extracts:
+                write_extract(extract)
+        else:
+            pool = ThreadPool(jobs)
+            try:
+                pool.map(write_extract, extracts)
+            finally:
+                pool.close()
+                pool.join()
+
+        with open(os.path.join(directory, EXPLODE_INDEX_FILENAME), 'w') as wf:
+            json.dump(index, wf, indent=2, sort_keys=True)
+        return len(extracts) + 1
+
+    def get_occupancy(self):
+        """Classify each erase block of the ROMimage
+
+        Returns a string of one BLOCK_xxx class per erase block: header
+        blocks, blocks holding any part of an element, and, of the rest,
+        those filled with 0x00, those filled with 0xff and those holding
+        stray data.  Blocks are checked with get_fill_byte, so only the
+        unclaimed blocks are scanned, and then at C speed.
+        """
+        if not self.ffff0:
+            raise ValueError("No FFFF to scan")
+        block_size = self.erase_block_size
+        num_blocks = (len(self.ffff_buf) + block_size - 1) // block_size
+        occupancy = [None] * num_blocks
+
+        def mark(start, length, block_class):
+            first = start // block_size
+            last = min((start + length + block_size - 1) // block_size,
+                       num_blocks)
+            for block in range(first, last):
+                occupancy[block] = block_class
+
+        # Element spans, then the header blocks (which trump any element
+        # wrongly placed over them)
+        ffffs = [ffff for ffff in (self.ffff0, self.ffff1) if ffff]
+        for ffff in ffffs:
+            for element in ffff.elements:
+                if element.element_type != \
+                   FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
+                    mark(element.element_location, element.element_length,
+                         BLOCK_ELEMENT)
+        for ffff in ffffs:
+            mark(ffff.header_offset, self.get_header_block_size(),
+                 BLOCK_HEADER)
+
+        # Sort the rest by content
+        for block, block_class in enumerate(occupancy):
+            if block_class is None:
+                fill_byte = get_fill_byte(buffer_view(self.ffff_buf,
+                                                      block * block_size,
+                                                      block_size))
+                if fill_byte == 0x00:
+                    occupancy[block] = BLOCK_ZEROED
+                elif fill_byte == 0xff:
+                    occupancy[block] = BLOCK_ERASED
+                else:
+                    occupancy[block] = BLOCK_STRAY
+        return "".join(occupancy)
+
+    def display_occupancy(self):
+        """Display the erase-block occupancy map and totals"""
+        occupancy = self.get_occupancy()
+        block_size = self.erase_block_size
+        print("Erase-block occupancy ({0:d} blocks of 0x{1:x} bytes):".
+              format(len(occupancy), block_size))
+        for start in range(0, len(occupancy), OCCUPANCY_MAP_WIDTH):
+            print("  {0:08x} {1:s}".format(
+                  start * block_size,
+                  occupancy[start:start + OCCUPANCY_MAP_WIDTH]))
+        print("Totals:")
+        for block_class, name in BLOCK_CLASS_NAMES:
+            count = occupancy.count(block_class)
+            print("  {0:s} {1:18s} {2:6d} blocks  0x{3:08x} bytes".
+                  format(block_class, name, count, count * block_size))
+
     def create_map_file(self, base_name, base_offset):
         """Create a map file from the base name
 
@@ -368,7 +775,7 @@ class FfffRomimage:
         if index != -1:
             base_name = base_name[:index]
         map_name = base_name + ".map"
-        with open(map_name, 'w') as mapfile:
+        with create_file(map_name, 'w') as mapfile:
             self.write_map(mapfile, base_offset)
 
     def write_map(self, wf, base_offset):
@@ -37,10 +37,9 @@ import os
 import subprocess
 import threading
 import Queue
-import serial
-import termios
-import Adafruit_GPIO as GPIO
-import Adafruit_GPIO.FT232H as FT232H
+# serial, termios and Adafruit_GPIO are imported by the functions which use
+# them, so that importing this module (e.g., for "--help") stays cheap and
+# doesn't require the hardware libraries.
 
 # haps_monitor class "monitor" status values
 HAPS_MONITOR_TIMEOUT = 0
@@ -194,6 +193,7 @@ def haps_board_ready(chipit_name):
     # Monitor the ChipIT TTY and return when we see the "HAPS62>" prompt.
     # Will actively probe for the prompt after a while.
     # Returns True when synchronized, False if not
+    import serial
     have_prompt = False
     issued_boot_msg = False
 
@@ -248,6 +248,8 @@ def init_adafruit_ft232h():
     # Apply or remove the reset from the SPIROM daughterboard
     # via a GPIO on the AdaFruit FT232H SPI/I2C/UART/GPIO breakout board.
     global ft232h, adafruit_initialized
+    import Adafruit_GPIO as GPIO
+    import Adafruit_GPIO.FT232H as FT232H
 
     if not adafruit_initialized:
         # Temporarily disable the built-in FTDI serial driver on Mac & Linux
@@ -276,6 +278,7 @@ def reset_spirom_daughterboard_adafruit_ft232h(apply_reset):
     # Apply or remove the reset from the SPIROM daughterboard
     # via a GPIO on the AdaFruit FT232H SPI/I2C/UART/GPIO breakout board.
     global ft232h, adafruit_initialized
+    import Adafruit_GPIO as GPIO
     if not adafruit_initialized:
         init_adafruit_ft232h()
 
@@ -397,6 +400,7 @@ class WorkerThread(threading.Thread):
         if os.name != "posix":
             raise ValueError("Can only be run on Posix systems")
             return
+        import termios
 
         buffer = ""
         # While PySerial would be preferable and more machine-independant,
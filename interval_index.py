@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+
+#
+# Copyright (c) 2015 Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+## Interval index for detecting overlapping sections and elements
+#
+
+from __future__ import print_function
+from bisect import bisect_left
+from heapq import heappush, heappop
+
+
+class IntervalIndex:
+    """A sorted index of [start, end) intervals
+
+    Each interval carries a key (typically the index of the TFTF section or
+    FFFF element it describes).  The index answers overlap, point and range
+    queries without comparing every interval against every other.  Empty
+    intervals never overlap anything.
+    """
+
+    def __init__(self):
+        self.intervals = []     # (start, end, key), sorted by start
+        self.starts = []        # interval starts, for bisection
+        self.max_length = 0     # longest interval, to bound range queries
+        self.dirty = False
+
+    def add(self, start, length, key):
+        """Add the interval [start, start + length) for key"""
+        self.intervals.append((start, start + length, key))
+        self.max_length = max(self.max_length, length)
+        self.dirty = True
+
+    def sort(self):
+        # (Re)build the sorted views after a batch of adds
+        if self.dirty:
+            self.intervals.sort(key=lambda interval: interval[0])
+            self.starts = [interval[0] for interval in self.intervals]
+            self.dirty = False
+
+    def overlaps(self):
+        """Find all overlapping intervals
+
+        Sweeps the intervals in start order, keeping a heap of those still
+        open.  Returns a dictionary mapping each key which overlaps
+        something to the sorted list of keys it overlaps.
+        """
+        self.sort()
+        overlaps = {}
+        active = []
+        for start, end, key in self.intervals:
+            if start >= end:
+                continue
+            # Retire the intervals which ended before this one starts
+            while active and active[0][0] <= start:
+                heappop(active)
+            for other_end, other_key in active:
+                overlaps.setdefault(key, []).append(other_key)
+                overlaps.setdefault(other_key, []).append(key)
+            heappush(active, (end, key))
+        for keys in overlaps.values():
+            keys.sort()
+        return overlaps
+
+    def find_range(self, start, end):
+        """Return the keys of all intervals overlapping [start, end)"""
+        self.sort()
+        if start >= end:
+            return []
+        # Only intervals starting in [start - max_length, end) can overlap
+        first = bisect_left(self.starts, start - self.max_length)
+        last = bisect_left(self.starts, end)
+        return [key for other_start, other_end, key in
+                self.intervals[first:last]
+                if other_start < other_end and other_end > start]
+
+    def find(self, point):
+        """Return the keys of all intervals containing point"""
+        return self.find_range(point, point + 1)
+
+
+def find_duplicates(items):
+    """Find items sharing the same identity
+
+    items is a sequence of (key, identity) pairs, where identity is any
+    hashable value (e.g., an (element_type, element_id, generation) tuple).
+    Returns a dictionary mapping each key whose identity is shared to the
+    sorted list of other keys with that identity.
+    """
+    by_identity = {}
+    for key, identity in items:
+        by_identity.setdefault(identity, []).append(key)
+
+    duplicates = {}
+    for keys in by_identity.values():
+        if len(keys) > 1:
+            for key in keys:
+                duplicates[key] = sorted(other for other in keys
+                                         if other != key)
+    return duplicates
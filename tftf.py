@@ -30,11 +30,16 @@
 
 from __future__ import print_function
 import os
-from struct import pack_into, unpack_from
+import mmap
+import hashlib
+import zlib
+from struct import Struct, pack_into, unpack_from
+from threading import Lock
 from string import rfind
-from time import gmtime, strftime
-from util import display_binary_data, error
+from util import display_binary_data, error, buffer_view, update_digest, \
+    get_timestamp, create_file, unshare_file
 from signature_block import signature_block_write_map
+from interval_index import IntervalIndex
 from signature_common import TFTF_SIGNATURE_ALGORITHM_RSA_2048_SHA_256
 
 # TFTF section types
@@ -204,6 +209,15 @@ TFTF_VALID_WITH_COLLISIONS = 2
 # Size of the blob to copy each time
 copy_blob_size = 1024*1024*10
 
+# Section compression methods (see: compress_section_data)
+TFTF_COMPRESSION_METHODS = ("zlib", "lzma", "lz4")
+
+# Raw section types and their compressed counterparts
+compressed_section_types = {
+    TFTF_SECTION_TYPE_RAW_CODE: TFTF_SECTION_TYPE_COMPRESSED_CODE,
+    TFTF_SECTION_TYPE_RAW_DATA: TFTF_SECTION_TYPE_COMPRESSED_DATA,
+}
+
 section_type_names = {
     TFTF_SECTION_TYPE_RESERVED: "Reserved",
     TFTF_SECTION_TYPE_RAW_CODE: "Code",
@@ -229,6 +243,142 @@ section_type_short_names = {
 }
 
 
+# Precompiled section descriptor format (type/class, id, length, load
+# address, expanded length)
+tftf_section_struct = Struct("<LLLLL")
+
+
+class TftfHeaderLayout:
+    """Field layout of a TFTF header of a given size
+
+    Because we have variable-size TFTF headers, the number of entries in
+    the section table, and the offsets to all fields which follow it,
+    depend on the header_size.  A layout captures these (and the
+    precompiled structs to unpack them) for one header_size.  Layouts are
+    shared between Tftf instances and must be treated as read-only; use
+    get_tftf_header_layout() to obtain one.
+    """
+    def __init__(self, header_size):
+        self.header_size = header_size
+
+        # TFTF section table and derived lengths
+        self.num_sections = \
+            ((header_size -
+             (TFTF_HDR_LEN_FIXED_PART + TFTF_HDR_LEN_MIN_RESERVED)) //
+             TFTF_SECTION_LEN)
+        self.len_section_table = self.num_sections * TFTF_SECTION_LEN
+
+        # (The reserved array is made up of what's left over after creating
+        # the section array.)
+        self.len_reserved = header_size - \
+            (TFTF_HDR_LEN_FIXED_PART + self.len_section_table)
+        self.num_reserved = self.len_reserved // TFTF_RSVD_SIZE
+
+        # Offsets to fields following the first variable-length table
+        # (Reserved)
+        self.off_reserved = TFTF_HDR_OFF_RESERVED
+        self.off_sections = self.off_reserved + self.len_reserved
+
+        # Precompiled formats for the fixed part + reserved table
+        self.header_struct = Struct("<4sL16s48sLLLLLL" +
+                                    "L" * self.num_reserved)
+        self.reserved_struct = Struct("<" + "L" * self.num_reserved)
+
+
+# Cache of TftfHeaderLayouts, indexed by header_size
+tftf_header_layouts = {}
+tftf_header_layouts_lock = Lock()
+
+
+def get_tftf_header_layout(header_size):
+    """Return the (shared, cached) TftfHeaderLayout for a header_size"""
+    with tftf_header_layouts_lock:
+        layout = tftf_header_layouts.get(header_size)
+        if not layout:
+            layout = TftfHeaderLayout(header_size)
+            tftf_header_layouts[header_size] = layout
+        return layout
+
+
+def compress_section_data(data, method):
+    """Compress a section payload
+
+    Compresses data with the named method (one of TFTF_COMPRESSION_METHODS)
+    and returns the compressed blob:
+        zlib: zlib stream (RFC 1950), maximum compression
+        lzma: legacy ".lzma" (LZMA-alone) stream
+        lz4:  raw LZ4 block (the expanded length is in the section
+              descriptor)
+    lzma and lz4 need the (backports.)lzma and lz4 packages respectively.
+    Raises ValueError if the method is unknown or unavailable.
+    """
+    if method == "zlib":
+        return zlib.compress(bytes(data), 9)
+    elif method == "lzma":
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise ValueError("lzma compression requires backports.lzma")
+        return lzma.compress(bytes(data), format=lzma.FORMAT_ALONE)
+    elif method == "lz4":
+        try:
+            import lz4.block
+        except ImportError:
+            raise ValueError("lz4 compression requires the lz4 package")
+        return lz4.block.compress(bytes(data), store_size=False)
+    raise ValueError("Unknown compression method '{0:s}'".format(method))
+
+
+def find_tftf_file(filename):
+    """Resolve a TFTF filename as load_tftf_file does
+
+    Returns filename if it exists, otherwise filename with the default TFTF
+    file extension appended if that exists, and otherwise filename.
+    """
+    for name in (filename, filename + TFTF_FILE_EXTENSION):
+        if os.path.isfile(name):
+            return name
+    return filename
+
+
+class TftfFileSegment:
+    """A TFTF section payload which lives in (part of) a file
+
+    Lets a TFTF be assembled as a list of section sources, with the payload
+    only being read as it is written out.
+    """
+    def __init__(self, filename, offset=0, length=None):
+        self.filename = filename
+        self.offset = offset
+        if length is None:
+            length = os.stat(filename).st_size - offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self):
+        """Return the segment contents"""
+        with open(self.filename, 'rb') as rf:
+            rf.seek(self.offset)
+            return rf.read(self.length)
+
+    def iter_blobs(self):
+        """Yield the segment contents, copy_blob_size bytes at a time"""
+        with open(self.filename, 'rb') as rf:
+            rf.seek(self.offset)
+            remaining = self.length
+            while remaining > 0:
+                blob = rf.read(min(remaining, copy_blob_size))
+                if not blob:
+                    raise IOError("{0:s} is truncated".format(self.filename))
+                remaining -= len(blob)
+                yield blob
+
+
 class TftfSection:
     """TFTF Section representation"""
     def __init__(self, section_type, section_class=0, section_id=0,
@@ -250,15 +400,17 @@ class TftfSection:
             self.load_address = load_address
         self.expanded_length = extended_length
         self.filename = filename
+        # Payload for a section added after the TFTF buffer was built (a
+        # buffer or TftfFileSegment), or None if it is in the TFTF buffer.
+        self.payload = None
 
         # Try to size the section length from the section input file
         if filename:
             try:
                 statinfo = os.stat(filename)
-                # TODO: Lengths will be different if/when we support
-                # compression:
-                # - section_length will shrink to the compressed size
-                # - expanded_length will remain the input file length
+                # (Compressed sections are added via Tftf.add_section,
+                # where section_length is the compressed size and
+                # expanded_length the input file length.)
                 self.section_length = statinfo.st_size
                 self.expanded_length = statinfo.st_size
             except:
@@ -267,7 +419,8 @@ class TftfSection:
     def unpack(self, section_buf, section_offset):
         # Unpack a section header from a TFTF header buffer, and return
         # a flag indicating if the section was a section-end
-        section_hdr = unpack_from("<LLLLL", str(section_buf), section_offset)
+        section_hdr = tftf_section_struct.unpack_from(section_buf,
+                                                      section_offset)
         type_class = section_hdr[0]
         self.section_type = type_class & 0x000000ff
         self.section_class = (type_class >> 8) & 0x00ffffff
@@ -281,12 +434,12 @@ class TftfSection:
         # Pack a section header into a TFTF header buffer at the specified
         # offset, returning the offset of the next section.
         type_class = (self.section_class << 8) | self.section_type
-        pack_into("<LLLLL", buf, offset,
-                  type_class,
-                  self.section_id,
-                  self.section_length,
-                  self.load_address,
-                  self.expanded_length)
+        tftf_section_struct.pack_into(buf, offset,
+                                      type_class,
+                                      self.section_id,
+                                      self.section_length,
+                                      self.load_address,
+                                      self.expanded_length)
         return offset + TFTF_SECTION_LEN
 
     def section_name(self, section_type):
@@ -362,7 +515,7 @@ class TftfSection:
 
 class Tftf:
     """TFTF representation"""
-    def __init__(self, header_size, filename=None):
+    def __init__(self, header_size, filename=None, use_mmap=False):
         """ TFTF constructor
 
         Basically, there are 2 logical constructor forms:
@@ -372,6 +525,10 @@ class Tftf:
         following forms:
             - Tftf(header_size, None) # create a blank TFTF
             - Tftf(0, filename)       # read an existing TFTF
+
+        If use_mmap is set, an existing TFTF file is mapped rather than
+        read, and the section payloads are only copied if the TFTF is
+        subsequently modified (see: materialize).
         """
         # Size the buffer: if we're creating a blank TFTF use the supplied
         # header_size. If we're loading it from a file, (header_size = 0 and
@@ -392,6 +549,7 @@ class Tftf:
         self.collisions_found = False
         self.header_validity = TFTF_INVALID
         self.tftf_length = 0  # length of the whole blob
+        self.tftf_map = None  # mmap backing tftf_buf (use_mmap mode)
 
         # Header fields
         self.sentinel = 0
@@ -404,13 +562,15 @@ class Tftf:
         self.unipro_pid = 0
         self.ara_vid = 0
         self.ara_pid = 0
-        self.reserved = [0] * TFTF_HDR_NUM_RESERVED
+        self.layout = get_tftf_header_layout(header_size or
+                                             TFTF_HEADER_SIZE_DEFAULT)
+        self.reserved = [0] * self.layout.num_reserved
         self.sections = []
 
         if filename:
             # Load the TFTF buffer and parse it for the TFTF header and
             # section list
-            self.load_tftf_file(filename)
+            self.load_tftf_file(filename, use_mmap)
         else:
             # Salt the list with the end-of-table, because we will be
             # adding sections manually later
@@ -425,37 +585,22 @@ class Tftf:
             self.recalculate_header_offsets()
 
     def recalculate_header_offsets(self):
-        """ Recalculate section table size and offsets from header_size
+        """ Select the header layout matching header_size
 
-        Because we have variable-size TFTF headers, we need to recalculate the
-        number of entries in the section table, and the offsets to all fields
-        which follow.
+        Because we have variable-size TFTF headers, the number of entries in
+        the section table, and the offsets to all fields which follow, depend
+        on the header size.  These live in a per-instance (shared, read-only)
+        TftfHeaderLayout rather than in module globals, so TFTFs with
+        different header sizes can be handled concurrently.
         """
-        global TFTF_HDR_NUM_SECTIONS, TFTF_HDR_LEN_SECTION_TABLE, \
-            TFTF_HDR_LEN_RESERVED, TFTF_HDR_OFF_RESERVED, \
-            TFTF_HDR_OFF_SECTIONS, TFTF_HDR_NUM_RESERVED
-        # TFTF section table and derived lengths
-        TFTF_HDR_NUM_SECTIONS = \
-            ((self.header_size -
-             (TFTF_HDR_LEN_FIXED_PART + TFTF_HDR_LEN_MIN_RESERVED)) //
-             TFTF_SECTION_LEN)
-        TFTF_HDR_LEN_SECTION_TABLE = (TFTF_HDR_NUM_SECTIONS * TFTF_SECTION_LEN)
-
-        # (The reserved array is made up of what's left over after creating the
-        # section array.)
-        TFTF_HDR_LEN_RESERVED = \
-            self.header_size - \
-            (TFTF_HDR_LEN_FIXED_PART + TFTF_HDR_LEN_SECTION_TABLE)
-        TFTF_HDR_NUM_RESERVED = TFTF_HDR_LEN_RESERVED / TFTF_RSVD_SIZE
+        self.layout = get_tftf_header_layout(self.header_size)
 
         # DO NOT CLEAR RESERVED - IT IS USED FOR TFTF VERSION
-        #self.reserved = [0] * TFTF_HDR_NUM_RESERVED
-        # Offsets to fields following the first variable-length table
-        # (Reserved)
-        TFTF_HDR_OFF_SECTIONS = (TFTF_HDR_OFF_RESERVED +
-                                 TFTF_HDR_LEN_RESERVED)
+        # (Just resize it to fit the new layout)
+        num_reserved = self.layout.num_reserved
+        self.reserved = (self.reserved + [0] * num_reserved)[:num_reserved]
 
-    def load_tftf_file(self, filename):
+    def load_tftf_file(self, filename, use_mmap=False):
         """Try to import a TFTF header and/or file
 
         If "buf" is None, then we only import the TFTF header.  However, if
@@ -463,20 +608,20 @@ class Tftf:
         entire TFTF file is also imported into the buffer.  This is to allow
         for cases where the caller needs to determine the TFTF characteristics
         before creating their buffer.
+
+        If use_mmap is set, the file is mapped read-only instead of being
+        read in, the header and section table are parsed in place, and the
+        section payloads are available as views via get_section_data.
         """
         success = True
         if filename:
-            # Try to open the file, and if that fails, try appending the
-            # extension.
-            names = (filename, filename + TFTF_FILE_EXTENSION)
-            rf = None
-            for name in names:
-                try:
-                    rf = open(name, 'rb')
-                    break
-                except:
-                    print("can't find TFTF file"), filename
-                    success = False
+            # Open the file, or failing that, the file with the extension
+            # appended (see: find_tftf_file)
+            try:
+                rf = open(find_tftf_file(filename), 'rb')
+            except IOError:
+                print("can't find TFTF file", filename)
+                success = False
 
             if success:
                 # Record the length of the entire TFTF blob (this will be
@@ -485,24 +630,74 @@ class Tftf:
                 self.tftf_length = rf.tell()
 
                 rf.seek(0, 0)
-                # (Display-tftf case) Read the entire TFTF file into
-                # a local buffer
-                self.tftf_buf = bytearray(self.tftf_length)
-                rf.readinto(self.tftf_buf)
+                self.close()
+                if use_mmap and self.tftf_length >= TFTF_HEADER_SIZE_MIN:
+                    # Map the file and parse it in place
+                    self.tftf_map = mmap.mmap(rf.fileno(), 0,
+                                              access=mmap.ACCESS_READ)
+                    self.tftf_buf = self.tftf_map
+                else:
+                    # (Display-tftf case) Read the entire TFTF file into
+                    # a local buffer
+                    self.tftf_buf = bytearray(self.tftf_length)
+                    rf.readinto(self.tftf_buf)
                 rf.close()
                 self.unpack()
                 self.post_process()
         return success
 
+    def load_tftf_header(self, filename):
+        """Import just the TFTF header from a TFTF file
+
+        Reads only the first header_size bytes of the file, which is enough
+        to parse and sanity-check the header and section table (but not to
+        access the section payloads).  tftf_length is set to the file size.
+        Raises IOError if the file can't be read.
+        """
+        with open(filename, 'rb') as rf:
+            self.close()
+            self.tftf_length = os.fstat(rf.fileno()).st_size
+            self.tftf_buf = bytearray(rf.read(TFTF_HEADER_SIZE_DEFAULT))
+            if len(self.tftf_buf) < TFTF_HEADER_SIZE_MIN:
+                raise IOError("{0:s} is too short to be a TFTF".
+                              format(filename))
+
+            # Read the rest of a larger-than-default header
+            header_size = unpack_from("<L", self.tftf_buf,
+                                      TFTF_HDR_OFF_HEADER_SIZE)[0]
+            if header_size > len(self.tftf_buf) and \
+               header_size <= TFTF_HEADER_SIZE_MAX:
+                self.tftf_buf += rf.read(header_size - len(self.tftf_buf))
+        self.unpack()
+
     def load_tftf_from_buffer(self, buf):
         """Import a TFTF blob from a memory buffer"""
         self.tftf_buf = buf
         self.unpack()
 
+    def materialize(self):
+        """Replace a mapped TFTF buffer with a private, writable copy
+
+        Called before anything modifies the TFTF buffer.  A no-op if the
+        TFTF was not loaded with use_mmap.
+        """
+        if self.tftf_map:
+            self.tftf_buf = bytearray(self.tftf_map)
+            self.close()
+
+    def close(self):
+        """Release any mmap backing the TFTF buffer
+
+        Views previously returned by get_section_data become invalid.
+        """
+        if self.tftf_map:
+            self.tftf_map.close()
+            self.tftf_map = None
+
     def unpack(self):
-        # Unpack a TFTF header from a buffer
-        fmt_string = "<4sL16s48sLLLLLL" + "L" * TFTF_HDR_NUM_RESERVED
-        tftf_hdr = unpack_from(fmt_string, str(self.tftf_buf))
+        # Unpack a TFTF header from a buffer.  Start with the fixed part to
+        # learn the header_size.
+        tftf_hdr = self.layout.header_struct.unpack_from(self.tftf_buf)
         self.sentinel = tftf_hdr[0]
         self.header_size = tftf_hdr[1]
         self.timestamp = tftf_hdr[2]
@@ -517,18 +712,24 @@ class Tftf:
         # Since the imported header_size may be different from our 512-byte
         # default, we need to recalculate the size of the reserved and
         # section tables and their offsets
-        self.recalculate_header_offsets()
-
-        for i in range(TFTF_HDR_NUM_RESERVED):
-            self.reserved[i] = tftf_hdr[10+i]
+        if self.layout.header_size != self.header_size:
+            if (self.header_size < TFTF_HEADER_SIZE_MIN) or \
+               (self.header_size > TFTF_HEADER_SIZE_MAX):
+                error("TFTF header size is out of range")
+                self.header_validity = TFTF_INVALID
+                self.sections = []
+                return
+            self.recalculate_header_offsets()
+            tftf_hdr = self.layout.header_struct.unpack_from(self.tftf_buf)
+        self.reserved = list(tftf_hdr[10:])
 
         # Purge (the EOT from) the list because we're populating the entire
         # list from the file
         self.sections = []
 
         # Parse the table of section headers
-        section_offset = TFTF_HDR_OFF_SECTIONS
-        for section_index in range(TFTF_HDR_NUM_SECTIONS):
+        section_offset = self.layout.off_sections
+        for section_index in range(self.layout.num_sections):
             section = TftfSection(0)
             if section.unpack(self.tftf_buf, section_offset):
                 self.sections.append(section)
@@ -548,6 +749,8 @@ class Tftf:
         # Pack the TFTF header members into the TFTF header buffer, prior
         # to writing the buffer out to a file.
 
+        self.materialize()
+
         # Populate the fixed part of the TFTF header.
         # (Note that we need to break up the packing because the "s" format
         # doesn't zero-pad a string shorter than the field width)
@@ -555,9 +758,8 @@ class Tftf:
                   self.sentinel,
                   self.header_size,
                   self.timestamp)
-        if self.firmware_package_name:
-            pack_into("<48s", self.tftf_buf, TFTF_HDR_OFF_NAME,
-                      self.firmware_package_name)
+        pack_into("<48s", self.tftf_buf, TFTF_HDR_OFF_NAME,
+                  self.firmware_package_name or "")
         pack_into("<LLLLLL", self.tftf_buf, TFTF_HDR_OFF_PACKAGE_TYPE,
                   self.package_type,
                   self.start_location,
@@ -565,46 +767,54 @@ class Tftf:
                   self.unipro_pid,
                   self.ara_vid,
                   self.ara_pid)
-        for i in range(TFTF_HDR_NUM_RESERVED):
-            pack_into("<L", self.tftf_buf,
-                      TFTF_HDR_OFF_RESERVED + (TFTF_RSVD_SIZE * i),
-                      self.reserved[i])
+        self.layout.reserved_struct.pack_into(self.tftf_buf,
+                                              self.layout.off_reserved,
+                                              *self.reserved)
 
         # Pack the section headers into the TFTF header buffer
-        offset = TFTF_HDR_OFF_SECTIONS
+        offset = self.layout.off_sections
         for section in self.sections:
             offset = section.pack(self.tftf_buf, offset)
 
     def add_section(self, section_type, section_class, section_id,
-                    section_data, load_address=0):
+                    section_data, load_address=0, expanded_length=None):
         # Add a new section to the section table and return a success flag
         #
         # (This would be called by "sign-tftf" to add signature and
         # certificate blocks.)
+        #
+        # section_data may be a buffer or a TftfFileSegment.  Either way, it
+        # is recorded against the section rather than appended to the TFTF
+        # buffer, and is only copied out when the TFTF is written.
+        #
+        # expanded_length defaults to the length of section_data, and is
+        # only given for compressed sections.
         num_sections = len(self.sections)
-        if num_sections < TFTF_HDR_NUM_SECTIONS:
+        if num_sections < self.layout.num_sections:
             # Insert the section to the section list, just in front of
             # the end-of-table marker.
             #
             # Notes:
-            #   1. We assume this is an uncompressable section
+            #   1. Unless told otherwise, we assume this is an uncompressed
+            #      section
             #   2. We defer pushing the new section into the buffer until
             #      the write stage or someone explicitly calls "pack".)
-            self.sections.insert(num_sections - 1,
-                                 TftfSection(section_type,
-                                             section_class,
-                                             section_id,
-                                             len(section_data),
-                                             load_address,
-                                             len(section_data),
-                                             None))
-
-            # Append the section data blob to our TFTF buffer
-            self.tftf_buf += section_data
+            if expanded_length is None:
+                expanded_length = len(section_data)
+            section = TftfSection(section_type,
+                                  section_class,
+                                  section_id,
+                                  len(section_data),
+                                  load_address,
+                                  expanded_length,
+                                  None)
+            section.payload = section_data
+            self.sections.insert(num_sections - 1, section)
 
             # Record the length of the entire TFTF blob (this will be longer
             # than the header's load_length)
-            self.tftf_length = len(self.tftf_buf)
+            self.tftf_length = max(self.tftf_length, len(self.tftf_buf)) + \
+                len(section_data)
             return True
         else:
             error("Section table full")
@@ -616,53 +826,106 @@ class Tftf:
         #
         # (This would be called by "create-tftf" while/after parsing section
         # parameters)
-        if len(self.sections) < TFTF_HDR_NUM_SECTIONS:
+        if len(self.sections) < self.layout.num_sections:
             try:
-                with open(filename, 'rb') as readfile:
-                    section_data = readfile.read()
-
-                return self.add_section(section_type, section_class,
-                                        section_id, section_data,
-                                        load_address)
+                if not os.access(filename, os.R_OK):
+                    raise IOError(filename)
+                section_data = TftfFileSegment(filename)
             except:
                 error("Unable to read", filename)
                 return False
+            return self.add_section(section_type, section_class,
+                                    section_id, section_data,
+                                    load_address)
         else:
             error("Section table full")
             return False
 
+    def load_payloads(self):
+        """Read any file-backed section payloads into memory
+
+        Used when the same sections are to be written out many times (e.g.,
+        under different headers), so that each file is read only once.
+        Raises IOError if a payload can't be read.
+        """
+        for section in self.sections:
+            if isinstance(section.payload, TftfFileSegment):
+                data = section.payload.read()
+                if len(data) != len(section.payload):
+                    raise IOError("{0:s} is truncated".
+                                  format(section.payload.filename))
+                section.payload = data
+
+    def replace_section_in_place(self, filename, section_index,
+                                 section_data):
+        """Replace a section's payload in an existing TFTF file
+
+        The TFTF must have been loaded from filename (which, as with
+        load_tftf_file, may omit the default extension).  The file is mapped
+        and only the section payload is overwritten.  If the payload changes
+        size, the rest of the file is shifted in place and the section
+        descriptor is patched with the new length.  The TFTF is then
+        reloaded (mapped) from the updated file.
+
+        (Used by "sign-tftf --resign" to replace a signature.)
+        Raises IOError if the file can't be updated.
+        """
+        section = self.sections[section_index]
+        offset = self.get_section_offset(section_index)
+        old_length = section.section_length
+        new_length = len(section_data)
+        filename = find_tftf_file(filename)
+        self.close()
+        unshare_file(filename)
+        with open(filename, 'r+b') as f:
+            file_length = os.fstat(f.fileno()).st_size
+            old_end = offset + old_length
+            if old_end > file_length:
+                raise IOError("{0:s} is truncated".format(filename))
+            new_file_length = file_length + new_length - old_length
+            if new_file_length > file_length:
+                f.truncate(new_file_length)
+            tftf_map = mmap.mmap(f.fileno(), 0)
+            try:
+                if new_length != old_length and old_end < file_length:
+                    tftf_map.move(offset + new_length, old_end,
+                                  file_length - old_end)
+                tftf_map[offset:offset + new_length] = str(section_data)
+                if new_length != old_length:
+                    section.section_length = new_length
+                    section.expanded_length = new_length
+                    section.pack(tftf_map, self.layout.off_sections +
+                                 section_index * TFTF_SECTION_LEN)
+                tftf_map.flush()
+            finally:
+                tftf_map.close()
+            if new_file_length < file_length:
+                f.truncate(new_file_length)
+        if not self.load_tftf_file(filename, use_mmap=True):
+            raise IOError("Unable to reload {0:s}".format(filename))
+
     def check_for_collisions(self):
         # Scan the TFTF section table for collisions
         #
         # This would be called by "create-ffff" after parsing all of the
         # parameters and calling update_ffff_sections().
-
-        for comp_a, section_a in enumerate(self.sections):
-            collision = []
-            # extract sections[comp_a]
-            if section_a.section_type == TFTF_SECTION_TYPE_SIGNATURE or \
-               section_a.section_type == TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
+        #
+        # The sections preceding the first signature (or the end of the
+        # table) are checked for overlapping load ranges.
+        load_ranges = IntervalIndex()
+        num_sections = 0
+        for section in self.sections:
+            if section.section_type == TFTF_SECTION_TYPE_SIGNATURE or \
+               section.section_type == TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
                 break
-
-            start_a = section_a.load_address
-            end_a = start_a + section_a.expanded_length - 1
-            for comp_b, section_b in enumerate(self.sections):
-                # skip checking one's self
-                if comp_a != comp_b:
-                    # extract sections[comp_b]
-                    if section_b.section_type == \
-                       TFTF_SECTION_TYPE_SIGNATURE or \
-                       section_b.section_type == \
-                       TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
-                        break
-
-                    start_b = section_b.load_address
-                    end_b = start_b + section_b.expanded_length - 1
-                    if end_b >= start_a and \
-                       start_b <= end_a:
-                        self.collisions_found = True
-                        collision += [comp_b]
-            self.collisions += [collision]
+            load_ranges.add(section.load_address, section.expanded_length,
+                            num_sections)
+            num_sections += 1
+
+        overlaps = load_ranges.overlaps()
+        self.collisions = [overlaps.get(index, [])
+                           for index in range(num_sections)]
+        self.collisions_found = len(overlaps) > 0
         return self.collisions_found
 
     def sniff_test(self):
@@ -698,7 +961,7 @@ class Tftf:
         self.sentinel = TFTF_SENTINEL
         self.check_for_collisions()
         if self.timestamp == "":
-            self.timestamp = strftime("%Y%m%d %H%M%S", gmtime())
+            self.timestamp = get_timestamp()
 
         # Trim the name to length
         if self.firmware_package_name:
@@ -708,19 +971,27 @@ class Tftf:
         # Determine the validity
         self.sniff_test()
 
-    def write(self, out_filename):
+    def write(self, out_filename, digest=None):
         """Create the TFTF file and return a success flag
 
         Create the TFTF file (appending the default extension if omitted)
         and write the TFTF buffer to it.
+
+        If a digest (e.g., a hashlib object) is supplied, the signable part
+        of the TFTF (see: get_signable_ranges) is fed to it as the file is
+        written.
         """
         success = True
         # Prepare the output buffer
         self.pack()
+        if digest:
+            signable_ranges = self.get_signable_ranges()
 
         # Record the length of the entire TFTF blob (this will be longer
         # than the header's load_length)
-        self.tftf_length = len(self.tftf_buf)
+        self.tftf_length = len(self.tftf_buf) + \
+            sum(len(section.payload) for section in self.sections
+                if section.payload is not None)
 
         # Ensure the output file ends in the default TFTF file extension if
         # the user hasn't specified their own extension.
@@ -728,9 +999,16 @@ class Tftf:
             out_filename += TFTF_FILE_EXTENSION
 
         try:
-            with open(out_filename, 'wb') as wf:
-                # Write the TFTF header
-                wf.write(self.tftf_buf)
+            with create_file(out_filename) as wf:
+                # Write the TFTF header and the section payloads, piece by
+                # piece
+                position = 0
+                for blob in self.iter_blobs():
+                    wf.write(blob)
+                    if digest:
+                        update_digest(digest, blob, position,
+                                      signable_ranges)
+                    position += len(blob)
 
             # verify the file is the correct length
             try:
@@ -750,6 +1028,22 @@ class Tftf:
                 error("Failed to write", out_filename)
             return success
 
+    def iter_blobs(self):
+        """Yield the TFTF image as a series of blobs
+
+        Yields the TFTF buffer (the header, plus any section payloads
+        loaded with it), followed by the payloads of the sections added
+        since, without concatenating them.  The caller is responsible for
+        calling pack() first.
+        """
+        yield buffer_view(self.tftf_buf)
+        for section in self.sections:
+            if isinstance(section.payload, TftfFileSegment):
+                for blob in section.payload.iter_blobs():
+                    yield blob
+            elif section.payload is not None:
+                yield buffer_view(section.payload)
+
     def display(self, title=None, indent=""):
         """Display a single TFTF header"""
         # 1. Dump the contents of the fixed part of the TFTF header
@@ -800,14 +1094,14 @@ class Tftf:
                 print(section_string)
 
         # Note any unused sections
-        num_unused_sections = TFTF_HDR_NUM_SECTIONS - len(self.sections)
+        num_unused_sections = self.layout.num_sections - len(self.sections)
         if num_unused_sections > 1:
             print("{0:s}  {1:2d} (unused)".format(indent, len(self.sections)))
         if num_unused_sections > 2:
             print("{0:s}   :    :".format(indent))
         if num_unused_sections > 0:
             print("{0:s}  {1:2d} (unused)".
-                  format(indent, TFTF_HDR_NUM_SECTIONS-1))
+                  format(indent, self.layout.num_sections - 1))
         print(" ")
 
     def display_data(self, title=None, indent=""):
@@ -820,15 +1114,35 @@ class Tftf:
         print(title_string)
 
         # 2. Print the associated data blobs
-        offset = self.header_size
         for index, section in enumerate(self.sections):
             if section.section_type == TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
                 break
-            end = offset + section.section_length - 1
-            section.display_data(self.tftf_buf[offset:end],
+            section.display_data(self.get_section_data(index),
                                  "section [{0:d}] ".format(index),
                                  indent + "  ")
+
+    def get_section_offset(self, section_index):
+        """Return the offset of a section's payload within the TFTF blob"""
+        offset = self.header_size
+        for section in self.sections[:section_index]:
             offset += section.section_length
+        return offset
+
+    def get_section_data(self, section_index):
+        """Return a zero-copy view of a section's payload
+
+        The view references the TFTF buffer (or its mmap) directly; it is
+        only copied if the caller converts or slices it.  Payloads from a
+        TftfFileSegment are read in on demand.
+        """
+        payload = self.sections[section_index].payload
+        if isinstance(payload, TftfFileSegment):
+            return payload.read()
+        elif payload is not None:
+            return buffer_view(payload)
+        return buffer_view(self.tftf_buf,
+                           self.get_section_offset(section_index),
+                           self.sections[section_index].section_length)
 
     def find_first_section(self, section_type):
         """Find the index of the first section of the specified type
@@ -860,10 +1174,52 @@ class Tftf:
 
         # Flush any changes out to the buffer and return the substring
         self.pack()
-        slice_end = TFTF_HDR_OFF_SECTIONS + \
+        slice_end = self.layout.off_sections + \
             section_index * TFTF_SECTION_LEN
         return self.tftf_buf[0:slice_end]
 
+    def get_signable_ranges(self, section_index=None):
+        """Return the ranges of the TFTF image covered by a signature
+
+        The signable part of a TFTF consists of the first part of the TFTF
+        header (up to the Ith section descriptor), and the payloads of the
+        sections preceding it.  If no section_index is given, the first
+        signature descriptor (or the end-of-table) is used.
+
+        Returns a list of (start, end) offsets in the TFTF image.
+        """
+        if section_index is None:
+            section_index = \
+                self.find_first_section(TFTF_SECTION_TYPE_SIGNATURE)
+        header_end = self.layout.off_sections + \
+            section_index * TFTF_SECTION_LEN
+        return [(0, header_end),
+                (self.header_size, self.get_section_offset(section_index))]
+
+    def get_signable_digest(self, hash_algorithm, section_index=None):
+        """Hash the signable part of the TFTF
+
+        Streams the first part of the TFTF header and the preceding section
+        payloads (see: get_signable_ranges) through the named hashlib
+        algorithm (e.g., "sha256") without assembling them into a single
+        blob.  Returns the hashlib object.
+
+        A TFTF loaded with use_mmap is hashed as it is in the file (i.e.,
+        without re-packing the header), to avoid copying the file.
+        """
+        if not self.tftf_map:
+            self.pack()
+        digest = hashlib.new(hash_algorithm)
+        ranges = self.get_signable_ranges(section_index)
+        signable_end = max(end for start, end in ranges)
+        position = 0
+        for blob in self.iter_blobs():
+            if position >= signable_end:
+                break
+            update_digest(digest, blob, position, ranges)
+            position += len(blob)
+        return digest
+
     def get_section_data_up_to_section(self, section_index):
         """Return the section info for the first N sections
 
@@ -876,14 +1232,12 @@ class Tftf:
         if section_index > len(self.sections):
             return None
 
-        # Flush any changes out to the buffer and return the substring
+        # Flush any changes out to the buffer and gather the payloads
         self.pack()
-        slice_end = self.header_size
-        for index, section in enumerate(self.sections):
-            if index >= section_index:
-                break
-            slice_end += section.section_length
-        return self.tftf_buf[self.header_size:slice_end]
+        section_data = bytearray()
+        for index in range(section_index):
+            section_data += self.get_section_data(index)
+        return section_data
 
     def create_map_file(self, base_name, base_offset, prefix=""):
         """Create a map file from the base name
@@ -896,7 +1250,7 @@ class Tftf:
             base_name = base_name[:index]
         map_name = base_name + ".map"
         try:
-            with open(map_name, 'w') as mapfile:
+            with create_file(map_name, 'w') as mapfile:
                 self.write_map(mapfile, base_offset, prefix)
         except:
             error("Unable to write", map_name)
@@ -933,12 +1287,12 @@ class Tftf:
         for i in range(len(self.reserved)):
             wf.write("{0:s}reserved[{1:d}]  {2:08x}\n".
                      format(prefix, i,
-                            base_offset + TFTF_HDR_OFF_RESERVED +
+                            base_offset + self.layout.off_reserved +
                             (TFTF_RSVD_SIZE * i)))
 
         # Dump the section descriptors (used and free)
-        section_offset = base_offset + TFTF_HDR_OFF_SECTIONS
-        for index in range(TFTF_HDR_NUM_SECTIONS):
+        section_offset = base_offset + self.layout.off_sections
+        for index in range(self.layout.num_sections):
             wf.write("{0:s}section[{1:d}].type  {2:08x}\n".
                      format(prefix, index,
                             section_offset + TFTF_SECTION_OFF_TYPE))
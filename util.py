@@ -30,13 +30,23 @@
 
 from __future__ import print_function
 import sys
+import os
 import binascii
+import hashlib
+import mmap
+import shutil
+import stat
+import tempfile
+from time import gmtime, strftime, strptime
 
 # Program return values
 PROGRAM_SUCCESS = 0
 PROGRAM_WARNINGS = 1
 PROGRAM_ERRORS = 2
 
+# The format of TFTF and FFFF header timestamps
+TIMESTAMP_FORMAT = "%Y%m%d %H%M%S"
+
 
 def warning(*objs):
     """Print a warning message to stderr, prefixed with 'WARNING'"""
@@ -68,9 +78,172 @@ def next_boundary(location, block_size):
     return (location + (block_size - 1)) & ~(block_size - 1)
 
 
+def buffer_view(buf, offset=0, length=None):
+    """Return a read-only, zero-copy view into a buffer
+
+    Works on strings, bytearrays and mmaps alike.  The view is only
+    materialized (copied) if the caller converts or slices it.
+    """
+    if length is None:
+        return buffer(buf, offset)
+    return buffer(buf, offset, length)
+
+
+def copy_into(buf, offset, data):
+    """Copy data into a bytearray or writable mmap, at offset
+
+    (An mmap only accepts slice assignment from a string, so the data is
+    written to it through a view rather than being converted.)
+    """
+    if isinstance(buf, mmap.mmap):
+        buf.seek(offset)
+        buf.write(buffer_view(data))
+    else:
+        buf[offset:offset + len(data)] = data
+
+
+def create_file(filename, mode='wb'):
+    """Open a new file, replacing any existing file of that name
+
+    The existing file is unlinked rather than overwritten, so that if it
+    is hard-linked elsewhere (e.g. into the build cache, by --cache-link)
+    the other links keep their contents.
+    """
+    if os.path.lexists(filename):
+        os.remove(filename)
+    return open(filename, mode)
+
+
+def unshare_file(filename):
+    """Prepare a file to be modified in place
+
+    If the file is hard-linked elsewhere (e.g. into the build cache, by
+    --cache-link), it is replaced with a copy of its own (writable by its
+    owner), so that modifying it leaves the other links unchanged.
+    """
+    info = os.stat(filename)
+    if info.st_nlink > 1:
+        fd, temp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)), prefix=".tmp-")
+        os.close(fd)
+        try:
+            shutil.copyfile(filename, temp_filename)
+            os.chmod(temp_filename, stat.S_IMODE(info.st_mode) | stat.S_IWUSR)
+            os.rename(temp_filename, filename)
+        except EnvironmentError:
+            os.remove(temp_filename)
+            raise
+
+
+def write_view(filename, buf, offset, length):
+    """Write a range of a buffer (or mmap) to a new file
+
+    The range is handed to the file through a view, so it is written
+    straight from the buffer (or the mmapped pages) without being copied
+    into a string first.  (The GIL is released while it is written.)
+    """
+    with open(filename, 'wb') as wf:
+        wf.write(buffer_view(buf, offset, length))
+
+
+def update_digest(digest, blob, position, ranges):
+    """Hash the parts of a blob which fall within a set of ranges
+
+    blob is a piece of a larger stream, starting at "position" in that
+    stream.  Those parts of it which lie within any of the (start, end)
+    ranges (stream offsets, end exclusive) are fed to the digest, in order,
+    without copying.  This allows a digest to be computed over selected
+    parts of a stream as it is being written.
+    """
+    blob_end = position + len(blob)
+    for start, end in ranges:
+        start = max(start, position)
+        end = min(end, blob_end)
+        if start < end:
+            digest.update(buffer_view(blob, start - position, end - start))
+
+
+def block_digests(buf, offset, length, block_size):
+    """Hash a region of a buffer, block by block
+
+    Returns a list of the (SHA-1) digests of the successive block_size
+    blocks of buf[offset:offset + length] (the last may be short), so that
+    regions can be compared block-wise without copying them.
+    """
+    end = offset + length
+    return [hashlib.sha1(buffer_view(buf, start,
+                                     min(block_size, end - start))).digest()
+            for start in range(offset, end, block_size)]
+
+
+def get_source_date_epoch():
+    """Return $SOURCE_DATE_EPOCH (seconds since 1970) or None if not set
+
+    Raises ValueError if it is set to something other than an integer.
+    """
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if epoch is None or epoch == "":
+        return None
+    try:
+        return int(epoch)
+    except ValueError:
+        raise ValueError("Invalid SOURCE_DATE_EPOCH: {0:s}".format(epoch))
+
+
+def get_timestamp(epoch=None):
+    """Return a header timestamp string ("YYYYMMDD HHMMSS", UTC)
+
+    The timestamp is for "epoch" (seconds since 1970) if given, otherwise
+    for $SOURCE_DATE_EPOCH if that is set (for reproducible builds), and
+    otherwise for the current time.
+    """
+    if epoch is None:
+        epoch = get_source_date_epoch()
+    return strftime(TIMESTAMP_FORMAT, gmtime(epoch))
+
+
+def timestamp_arg(x):
+    """Convert a --timestamp argument into a header timestamp string
+
+    Accepts either seconds since 1970 or a "YYYYMMDD HHMMSS" string, and
+    raises ValueError for anything else.
+    """
+    if x.isdigit():
+        return get_timestamp(int(x))
+    strptime(x, TIMESTAMP_FORMAT)
+    return x
+
+
+def _countable(bytes):
+    # Return bytes as something with a (C-speed) count method: strings
+    # and bytearrays as-is, anything else (mmaps, views) as a string
+    if isinstance(bytes, (str, bytearray)):
+        return bytes
+    return str(buffer_view(bytes))
+
+
 def is_constant_fill(bytes, fill_byte):
-    """Check a range of bytes for a constant fill"""
-    return all(b == fill_byte for b in bytes)
+    """Check a range of bytes for a constant fill
+
+    Works on strings, bytearrays, mmaps and buffer views alike.
+    """
+    bytes = _countable(bytes)
+    return bytes.count(chr(fill_byte)) == len(bytes)
+
+
+def get_fill_byte(bytes):
+    """Return the value a range of bytes is filled with
+
+    Returns None if the range is empty or isn't a constant fill.  Works on
+    strings, bytearrays, mmaps and buffer views alike.
+    """
+    bytes = _countable(bytes)
+    if len(bytes) == 0:
+        return None
+    fill_byte = ord(bytes[0:1])
+    if bytes.count(chr(fill_byte)) == len(bytes):
+        return fill_byte
+    return None
 
 
 def display_binary_data(blob, show_all, indent=""):